@@ -1,19 +1,64 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager, contextmanager, AsyncExitStack
+from fastapi import FastAPI, HTTPException, Request, Query
+from fastapi.responses import StreamingResponse, Response
+from pydantic import BaseModel
+from typing import List, Literal, Optional
 from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from langchain_community.chat_models import ChatOpenAI
+from langchain_core.output_parsers import StrOutputParser
+from langchain_openai import ChatOpenAI
 from dotenv import load_dotenv
+import asyncio
+import httpx
+import json
+import time
+import unicodedata
+import sqlite3
+import queue
+import sys
 import os
 
+# 复用 pydantic-4-LLM 中定义的 CustomerIssue 模型
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pydantic-4-LLM"))
+from main import CustomerIssue
+
 load_dotenv() 
 apk_key_ali = os.getenv('DASHSCOPE_API_KEY')
 
-app = FastAPI()
+# pydantic-4-LLM 写入的客户问题数据库
+ISSUES_DB_PATH = os.getenv(
+    "ISSUES_DB_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pydantic-4-LLM", "customer_issues.db"),
+)
+ISSUES_DB_POOL_SIZE = int(os.getenv("ISSUES_DB_POOL_SIZE", "8"))
+
+# 并发配置：同时进行的 LLM 请求数、排队上限、排队最长等待秒数
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "256"))
+AI_MAX_QUEUE = int(os.getenv("AI_MAX_QUEUE", "512"))
+AI_QUEUE_TIMEOUT = float(os.getenv("AI_QUEUE_TIMEOUT", "5"))
+# 相同问题合并调用后，结果额外保留的秒数（0 表示只合并同时进行中的请求）
+AI_COALESCE_TTL = float(os.getenv("AI_COALESCE_TTL", "0"))
+
+# 整个进程共用一个 HTTP 连接池，避免每个请求重新建立 TLS 连接
+http_async_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=AI_MAX_CONCURRENCY, max_keepalive_connections=AI_MAX_CONCURRENCY),
+    timeout=httpx.Timeout(120.0, connect=10.0),
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await http_async_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 # 初始化LLM
 llm = ChatOpenAI(
     model_name="qwen3-coder-30b-a3b-instruct",
     openai_api_base="https://dashscope.aliyuncs.com/compatible-mode/v1",
-    openai_api_key=apk_key_ali
+    openai_api_key=apk_key_ali,
+    http_async_client=http_async_client,
+    stream_usage=True  # 流式输出的最后一个分片带上 token 用量
 )
 
 # 定义Prompt模板
@@ -30,31 +75,299 @@ prompt = PromptTemplate(
     template=template
 )
 
-# 创建链
-chain = LLMChain(llm=llm, prompt=prompt)
+# 创建链（LCEL 写法，支持 ainvoke 异步调用）
+chain = prompt | llm | StrOutputParser()
+# 流式链保留 AIMessageChunk，以便拿到最后的 usage_metadata
+stream_chain = prompt | llm
+
+
+class ConcurrencyLimiter:
+    """
+    限制同时进行的 LLM 请求数。超过并发上限的请求排队等待，
+    排队人数超过 max_queue 或等待超时则立即返回 429，而不是无限堆积。
+    """
+
+    def __init__(self, max_concurrency, max_queue, queue_timeout):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+        self.in_flight = 0
+        self.rejected = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def _reject(self):
+        self.rejected += 1
+        raise HTTPException(status_code=429, detail="服务繁忙，请稍后重试", headers={"Retry-After": "1"})
+
+    @asynccontextmanager
+    async def slot(self):
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            self._reject()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._reject()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+        }
+
+
+limiter = ConcurrencyLimiter(AI_MAX_CONCURRENCY, AI_MAX_QUEUE, AI_QUEUE_TIMEOUT)
+
+
+def normalize_prompt(question: str) -> str:
+    """统一全角/半角和空白，让同一问题的不同写法合并为同一次调用。"""
+    return " ".join(unicodedata.normalize("NFKC", question).split())
+
+
+class SingleFlight:
+    """
+    合并相同键的并发调用：第一个请求发起上游调用，其余请求等待同一个结果。
+    上游调用在独立的 Task 中执行，发起者断开连接不会取消其他等待者的结果。
+    ttl > 0 时，结果在完成后再保留 ttl 秒，用于吸收突发的重复请求。
+    """
+
+    def __init__(self, ttl: float = 0.0, max_recent: int = 1024):
+        self.ttl = ttl
+        self.max_recent = max_recent
+        self.calls = 0
+        self.coalesced = 0
+        self.ttl_hits = 0
+        self._inflight = {}
+        self._recent = {}
+
+    async def do(self, key, fn):
+        if self.ttl > 0:
+            cached = self._recent.get(key)
+            if cached is not None and time.monotonic() - cached[0] < self.ttl:
+                self.ttl_hits += 1
+                return cached[1]
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._on_done(key, t))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _on_done(self, key, task):
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None or self.ttl <= 0:
+            return
+        now = time.monotonic()
+        self._recent[key] = (now, task.result())
+        if len(self._recent) > self.max_recent:
+            self._recent = {k: v for k, v in self._recent.items() if now - v[0] < self.ttl}
+
+    def stats(self):
+        return {
+            "upstream_calls": self.calls,
+            "coalesced": self.coalesced,
+            "ttl_hits": self.ttl_hits,
+            "in_flight_keys": len(self._inflight),
+        }
+
 
+single_flight = SingleFlight(ttl=AI_COALESCE_TTL)
+
+
+
+class IssueItem(CustomerIssue):
+    id: int
+
+
+class IssuePage(BaseModel):
+    items: List[IssueItem]
+    next_cursor: Optional[int]
+
+
+class ReadOnlyPool:
+    """
+    只读 SQLite 连接池。连接以 mode=ro 打开，数据库为 WAL 模式时读取不会阻塞写入进程。
+    连接按需建立，最多 size 个，服务启动时数据库可以还不存在。
+    """
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self._slots = queue.Queue()
+        for _ in range(size):
+            self._slots.put(None)
+
+    def _connect(self):
+        if not os.path.exists(self.path):
+            raise HTTPException(status_code=503, detail="客户问题数据库尚未初始化")
+        conn = sqlite3.connect(f"file:{os.path.abspath(self.path)}?mode=ro", uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def connection(self):
+        conn = self._slots.get()
+        try:
+            if conn is None:
+                conn = self._connect()
+            yield conn
+        finally:
+            self._slots.put(conn)
+
+
+issues_db = ReadOnlyPool(ISSUES_DB_PATH, ISSUES_DB_POOL_SIZE)
+
+ISSUE_COLUMNS = "id, customer_name, product, issue_description, priority, assigned_department"
+
+
+def _json_response(model: BaseModel) -> Response:
+    # 数据来自已经验证过的数据库行，直接序列化，不再逐行验证
+    return Response(content=model.model_dump_json(), media_type="application/json")
 
 
 def get_item_info_from_DB(item_id : int):
-    # 模拟数据库查询操作
-    return item_id+10
+    with issues_db.connection() as conn:
+        row = conn.execute(f"SELECT {ISSUE_COLUMNS} FROM issues WHERE id = ?", (item_id,)).fetchone()
+    return IssueItem.model_construct(**dict(row)) if row else None
+
 
+# 同步 def：SQLite 查询在线程池中执行，不阻塞事件循环
+@app.get("/items/", response_model=IssuePage)
+def read_items(
+    cursor: Optional[int] = Query(None, description="上一页返回的 next_cursor，第一页不传"),
+    limit: int = Query(10, ge=1, le=200),
+    priority: Optional[Literal["低", "中", "高", "紧急"]] = None,
+    department: Optional[str] = None,
+):
+    """
+    按 id 游标分页（keyset）：WHERE id > cursor ORDER BY id，配合 (priority, id)、
+    (assigned_department, id) 索引，无论翻到第几页都只扫描 limit 行，不使用 OFFSET。
+    """
+    conditions, params = ["id > ?"], [cursor or 0]
+    if priority:
+        conditions.append("priority = ?")
+        params.append(priority)
+    if department:
+        conditions.append("assigned_department = ?")
+        params.append(department)
+    # 多取一行判断是否还有下一页
+    sql = f"SELECT {ISSUE_COLUMNS} FROM issues WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?"
+    with issues_db.connection() as conn:
+        rows = conn.execute(sql, (*params, limit + 1)).fetchall()
 
-@app.get("/items/")
-async def read_items(skip: int = 0, limit: int = 10):  # 默认值使其成为可选参数
-    # 这里通常会从数据库获取数据，使用 skip 和 limit
-    return {"skip": skip, "limit": limit}
+    items = [IssueItem.model_construct(**dict(row)) for row in rows[:limit]]
+    next_cursor = items[-1].id if len(rows) > limit else None
+    return _json_response(IssuePage.model_construct(items=items, next_cursor=next_cursor))
 
-@app.get("/items/{item_id}")
-async def read_item(item_id : int) -> dict:
+@app.get("/items/{item_id}", response_model=IssueItem)
+def read_item(item_id : int):
     # 1. 从http请求得到item_id参数
     # 2. 从数据库里查询item_id对应的信息
     # 3. 返回查询结果
     item_info=get_item_info_from_DB(item_id)
-    return {"item_info": item_info}
+    if item_info is None:
+        raise HTTPException(status_code=404, detail="未找到该客户问题")
+    return _json_response(item_info)
 
 @app.get("/ai/")
-def ask_ai(question: str):
-    """调用大模型回答用户问题"""
-    response =  chain.run(question=question)
+async def ask_ai(question: str):
+    """调用大模型回答用户问题（异步，不占用线程池）"""
+    async def call_llm():
+        # 只有真正发起上游调用的请求才占用并发槽位
+        async with limiter.slot():
+            return await chain.ainvoke({"question": question})
+
+    response = await single_flight.do(normalize_prompt(question), call_llm)
     return {"question": question, "answer": response}
+
+class SlotStreamingResponse(StreamingResponse):
+    """
+    响应结束时调用 release() 释放并发槽位等资源。客户端提前断开、发送响应头失败，
+    以致响应体生成器从未开始迭代时也会执行，槽位不会泄漏。
+    """
+
+    def __init__(self, content, release, **kwargs):
+        super().__init__(content, **kwargs)
+        self._release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self._release()
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.get("/ai/stream")
+async def ask_ai_stream(question: str, request: Request):
+    """
+    以 Server-Sent Events 逐个推送 LLM 生成的 token：
+    event: token 携带文本片段，最后的 event: done 携带 token 用量和耗时。
+    客户端断开后立即关闭上游流，不再消耗 token。
+    """
+    # 在返回响应之前占用并发槽位，服务饱和时直接返回 429 而不是建立一个空流；
+    # 槽位由 SlotStreamingResponse 在响应结束时释放，生成器没有运行到 async with stack 也不会泄漏
+    stack = AsyncExitStack()
+    await stack.enter_async_context(limiter.slot())
+
+    async def event_stream():
+        async with stack:
+            start = time.perf_counter()
+            first_token_at = None
+            usage = None
+            disconnected = False
+            stream = stream_chain.astream({"question": question})
+            try:
+                async for chunk in stream:
+                    if await request.is_disconnected():
+                        disconnected = True
+                        break
+                    if chunk.usage_metadata:
+                        usage = chunk.usage_metadata
+                    if chunk.content:
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                        yield _sse("token", {"text": chunk.content})
+            finally:
+                await stream.aclose()
+            if not disconnected:
+                end = time.perf_counter()
+                yield _sse("done", {
+                    "question": question,
+                    "usage": usage,
+                    "time_to_first_token": round(first_token_at - start, 3) if first_token_at else None,
+                    "total_time": round(end - start, 3),
+                })
+
+    body = event_stream()
+
+    async def release():
+        await body.aclose()
+        await stack.aclose()
+
+    return SlotStreamingResponse(
+        body,
+        release,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/ai/stats")
+async def ai_stats():
+    """当前并发、排队、拒绝的请求数，以及合并调用的统计"""
+    return {"concurrency": limiter.stats(), "coalescing": single_flight.stats()}
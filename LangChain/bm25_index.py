@@ -0,0 +1,333 @@
+# bm25_index.py
+import re
+import json
+import math
+import os
+import sqlite3
+import threading
+from collections import Counter
+from typing import Any, List, Optional
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from pydantic import PrivateAttr
+
+try:
+    import jieba
+    jieba.setLogLevel(60)
+except ImportError:  # jieba 是可选依赖，没有时退化为中文二元组分词
+    jieba = None
+
+BM25_FILE = "bm25_index.json"
+BM25_SQLITE_FILE = "bm25_index.sqlite3"
+
+_TOKEN_RE = re.compile(r"[a-zA-Z0-9_]+|[一-鿿]+")
+
+
+def tokenize(text):
+    """
+    中英文混合分词：英文/数字按单词小写，中文优先用 jieba 搜索引擎模式，
+    没有安装 jieba 时使用字二元组（单字词保留单字）。
+    """
+    tokens = []
+    for piece in _TOKEN_RE.findall(text):
+        if piece.isascii():
+            tokens.append(piece.lower())
+        elif jieba is not None:
+            tokens.extend(t for t in jieba.lcut_for_search(piece) if t.strip())
+        elif len(piece) == 1:
+            tokens.append(piece)
+        else:
+            tokens.extend(piece[i:i + 2] for i in range(len(piece) - 1))
+    return tokens
+
+
+def _idf(n, df):
+    return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+
+class BM25Index:
+    """
+    与 Chroma 集合并存的 BM25 倒排索引，以 chunk_id 为文档键，支持增量添加和删除。
+    保存为 JSON（文本、元数据和词频），加载时重建倒排表，不需要重新分词。
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.docs = {}       # chunk_id -> (text, metadata)
+        self.doc_tf = {}     # chunk_id -> {term: tf}
+        self.doc_len = {}
+        self.postings = {}   # term -> {chunk_id: tf}
+        self.total_len = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __contains__(self, chunk_id):
+        return chunk_id in self.docs
+
+    def add(self, chunk_id, text, metadata=None, tf=None):
+        if chunk_id in self.docs:
+            return
+        tf = tf or dict(Counter(tokenize(text)))
+        self.docs[chunk_id] = (text, metadata or {})
+        self.doc_tf[chunk_id] = tf
+        length = sum(tf.values())
+        self.doc_len[chunk_id] = length
+        self.total_len += length
+        for term, count in tf.items():
+            self.postings.setdefault(term, {})[chunk_id] = count
+
+    def remove(self, chunk_id):
+        if chunk_id not in self.docs:
+            return
+        for term in self.doc_tf.pop(chunk_id):
+            posting = self.postings[term]
+            posting.pop(chunk_id, None)
+            if not posting:
+                del self.postings[term]
+        self.total_len -= self.doc_len.pop(chunk_id)
+        del self.docs[chunk_id]
+
+    def idf(self, term):
+        return _idf(len(self.docs), len(self.postings.get(term, ())))
+
+    def search(self, query, k=10):
+        """返回 [(chunk_id, score), ...]，按分数从高到低排序。"""
+        if not self.docs:
+            return []
+        avg_len = self.total_len / len(self.docs)
+        scores = Counter()
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = self.idf(term)
+            for chunk_id, tf in posting.items():
+                norm = self.k1 * (1 - self.b + self.b * self.doc_len[chunk_id] / avg_len)
+                scores[chunk_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores.most_common(k)
+
+    def match_ratio(self, query, score):
+        """
+        分数相对于“每个查询词在平均长度文档中出现一次”时的理想分数 (Σ idf) 的比例，约在 0~1 之间。
+        查询词在索引中不存在时按最大 idf 计入分母，因此缺词会拉低比例。
+        """
+        ideal = sum(self.idf(term) for term in set(tokenize(query)))
+        return score / ideal if ideal > 0 else 0.0
+
+    def document(self, chunk_id):
+        text, metadata = self.docs[chunk_id]
+        return Document(page_content=text, metadata=dict(metadata))
+
+    def update_metadata(self, chunk_id, metadata):
+        if chunk_id in self.docs:
+            self.docs[chunk_id] = (self.docs[chunk_id][0], metadata)
+
+    def save(self, persist_directory):
+        path = os.path.join(persist_directory, BM25_FILE)
+        data = {
+            "k1": self.k1,
+            "b": self.b,
+            "docs": {cid: [text, meta, self.doc_tf[cid]] for cid, (text, meta) in self.docs.items()},
+        }
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, persist_directory):
+        path = os.path.join(persist_directory, BM25_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        index = cls(k1=data["k1"], b=data["b"])
+        for chunk_id, (text, metadata, tf) in data["docs"].items():
+            index.add(chunk_id, text, metadata, tf=tf)
+        return index
+
+
+class SqliteBM25Index(BM25Index):
+    """
+    文本、元数据和倒排项保存在 SQLite 中的 BM25 索引，接口与 BM25Index 相同，用于流式入库的大规模语料：
+    add() 直接把 (term, chunk_id, tf) 写入磁盘，查询时只读取查询词的倒排项，
+    常驻内存的只有文档数和总长度，内存占用与语料大小无关。add() 不提交事务，save() 时提交。
+    """
+
+    def __init__(self, persist_directory, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        os.makedirs(persist_directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(persist_directory, BM25_SQLITE_FILE),
+                                     check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS docs (
+                chunk_id TEXT PRIMARY KEY,
+                length INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                metadata TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS terms (
+                term TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (term, chunk_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS terms_chunk_id ON terms (chunk_id);
+        """)
+        self._count, self.total_len = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs").fetchone()
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, chunk_id):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM docs WHERE chunk_id = ?", (chunk_id,)).fetchone() is not None
+
+    def add(self, chunk_id, text, metadata=None, tf=None):
+        tf = tf or dict(Counter(tokenize(text)))
+        length = sum(tf.values())
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO docs (chunk_id, length, text, metadata) VALUES (?, ?, ?, ?)",
+                (chunk_id, length, text, json.dumps(metadata or {}, ensure_ascii=False)),
+            )
+            if cursor.rowcount == 0:
+                return
+            self._conn.executemany("INSERT INTO terms (term, chunk_id, tf) VALUES (?, ?, ?)",
+                                   ((term, chunk_id, count) for term, count in tf.items()))
+            self._count += 1
+            self.total_len += length
+
+    def remove(self, chunk_id):
+        with self._lock:
+            row = self._conn.execute("SELECT length FROM docs WHERE chunk_id = ?", (chunk_id,)).fetchone()
+            if row is None:
+                return
+            self._conn.execute("DELETE FROM terms WHERE chunk_id = ?", (chunk_id,))
+            self._conn.execute("DELETE FROM docs WHERE chunk_id = ?", (chunk_id,))
+            self._count -= 1
+            self.total_len -= row[0]
+
+    def idf(self, term):
+        with self._lock:
+            df = self._conn.execute("SELECT COUNT(*) FROM terms WHERE term = ?", (term,)).fetchone()[0]
+        return _idf(self._count, df)
+
+    def search(self, query, k=10):
+        if not self._count:
+            return []
+        avg_len = self.total_len / self._count
+        scores = Counter()
+        for term in set(tokenize(query)):
+            with self._lock:
+                posting = self._conn.execute(
+                    "SELECT t.chunk_id, t.tf, d.length FROM terms t JOIN docs d ON d.chunk_id = t.chunk_id "
+                    "WHERE t.term = ?", (term,)
+                ).fetchall()
+            if not posting:
+                continue
+            idf = _idf(self._count, len(posting))
+            for chunk_id, tf, length in posting:
+                norm = self.k1 * (1 - self.b + self.b * length / avg_len)
+                scores[chunk_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores.most_common(k)
+
+    def document(self, chunk_id):
+        with self._lock:
+            text, metadata = self._conn.execute(
+                "SELECT text, metadata FROM docs WHERE chunk_id = ?", (chunk_id,)).fetchone()
+        return Document(page_content=text, metadata=json.loads(metadata))
+
+    def update_metadata(self, chunk_id, metadata):
+        with self._lock:
+            self._conn.execute("UPDATE docs SET metadata = ? WHERE chunk_id = ?",
+                               (json.dumps(metadata, ensure_ascii=False), chunk_id))
+
+    def save(self, persist_directory=None):
+        with self._lock:
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    @classmethod
+    def load(cls, persist_directory):
+        if not os.path.exists(os.path.join(persist_directory, BM25_SQLITE_FILE)):
+            return None
+        return cls(persist_directory)
+
+
+def load_index(persist_directory):
+    """加载目录中的 BM25 索引：流式入库生成的 SQLite 索引优先，其次是 JSON 索引，都没有时返回 None。"""
+    index = SqliteBM25Index.load(persist_directory)
+    return index if index is not None else BM25Index.load(persist_directory)
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    BM25 + 向量检索，用倒数排名融合 (RRF) 合并两路结果。
+    查询词很少且词法命中足够强（match_ratio >= fast_path_ratio）时直接返回 BM25 结果，
+    不计算查询向量，也不做向量搜索。
+    每个查询只做一次 BM25 搜索（取 max(k, fetch_k) 个结果），快速通道判断和 RRF 融合共用；
+    调用方先用 lexical_search + fast_path 判断、再调用 hybrid_search 时可以传入同一份结果。
+    """
+    vector_retriever: Any
+    bm25: Any
+    k: int = 4
+    fetch_k: int = 10
+    rrf_k: int = 60
+    fast_path_ratio: Optional[float] = 0.8
+    fast_path_max_terms: int = 6
+
+    _fast_path_hits: int = PrivateAttr(default=0)
+
+    def lexical_search(self, query: str):
+        """BM25 搜索，返回 [(chunk_id, score)]，供 fast_path 和 hybrid_search 共用。"""
+        return self.bm25.search(query, max(self.k, self.fetch_k))
+
+    def fast_path(self, query: str, hits=None) -> Optional[List[Document]]:
+        """词法命中足够强时返回 BM25 结果，否则返回 None。hits 为 lexical_search 的结果，不传时现查。"""
+        if self.fast_path_ratio is None or len(set(tokenize(query))) > self.fast_path_max_terms:
+            return None
+        hits = self.lexical_search(query) if hits is None else hits
+        if not hits or self.bm25.match_ratio(query, hits[0][1]) < self.fast_path_ratio:
+            return None
+        self._fast_path_hits += 1
+        return [self.bm25.document(chunk_id) for chunk_id, _ in hits[:self.k]]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        hits = self.lexical_search(query)
+        docs = self.fast_path(query, hits)
+        if docs is not None:
+            return docs
+        return self.hybrid_search(query, hits)
+
+    def hybrid_search(self, query: str, hits=None) -> List[Document]:
+        """不走快速通道的 BM25 + 向量检索 RRF 融合；hits 为 lexical_search 的结果，不传时现查。"""
+        hits = self.lexical_search(query) if hits is None else hits
+        lexical = [self.bm25.document(chunk_id) for chunk_id, _ in hits[:self.fetch_k]]
+        semantic = self.vector_retriever.invoke(query)
+
+        scores, by_id = Counter(), {}
+        for ranked in (lexical, semantic):
+            for rank, doc in enumerate(ranked):
+                key = doc.metadata.get("chunk_id") or doc.page_content
+                scores[key] += 1.0 / (self.rrf_k + rank + 1)
+                by_id.setdefault(key, doc)
+        return [by_id[key] for key, _ in scores.most_common(self.k)]
+
+    def embed_query(self, query):
+        return self.vector_retriever.embed_query(query)
+
+    def stats(self):
+        stats = self.vector_retriever.stats() if hasattr(self.vector_retriever, "stats") else {}
+        return {**stats, "lexical_fast_path": {"hits": self._fast_path_hits}}
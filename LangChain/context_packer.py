@@ -0,0 +1,168 @@
+# context_packer.py
+import re
+from functools import lru_cache
+
+# 与 LLM (qwen3-coder) 同一系列的分词器，只下载分词器文件，不加载模型
+DEFAULT_TOKENIZER = "Qwen/Qwen2.5-Coder-7B-Instruct"
+
+_SENTENCE_RE = re.compile(r"[^。！？!?\n]+[。！？!?]?")
+_NORMALIZE_RE = re.compile(r"[\s\W_]+")
+
+
+@lru_cache(maxsize=None)
+def get_token_counter(tokenizer_name=DEFAULT_TOKENIZER):
+    """
+    返回 text -> token 数 的函数。优先使用 transformers 的分词器，其次 tiktoken，
+    两者都不可用时按“中文一字一个 token、其他四个字符一个 token”估算。
+    """
+    try:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+        return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+    except Exception:
+        pass
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text))
+    except Exception:
+        pass
+    print("⚠️ 未找到可用的分词器，token 数按字符数估算。")
+
+    def estimate(text):
+        cjk = sum(1 for ch in text if "一" <= ch <= "鿿")
+        return cjk + (len(text) - cjk) // 4
+    return estimate
+
+
+def _bigrams(text):
+    text = _NORMALIZE_RE.sub("", text.lower())
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+
+def _overlap_length(left, right, max_overlap):
+    """left 的后缀与 right 的前缀最长重合的字符数。"""
+    for size in range(min(len(left), len(right), max_overlap), 0, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def split_sentences(text):
+    """按句切分，返回每个句子（去掉首尾空白）在 text 中的区间 [(start, end)]。"""
+    spans = []
+    for match in _SENTENCE_RE.finditer(text):
+        sentence = match.group()
+        start = match.start() + len(sentence) - len(sentence.lstrip())
+        end = match.start() + len(sentence.rstrip())
+        if end > start:
+            spans.append((start, end))
+    return spans
+
+
+def separator_between(text, end, start):
+    """
+    text[end:start] 是两个相邻的保留句子之间的原文（可能包含被删掉的句子）：
+    其中有换行时保留换行（最多两个），否则句子边界处原来有空白时用一个空格，没有时直接相连。
+    """
+    gap = text[end:start]
+    if "\n" in gap:
+        return "\n\n" if "\n\n" in gap or gap.count("\n") > 1 else "\n"
+    return " " if gap[:1].isspace() or gap[-1:].isspace() else ""
+
+
+def merge_adjacent(docs, max_overlap=100, min_overlap=10):
+    """
+    合并来自同一来源、相邻或互相重叠的文本块，去掉分割时重复出现的重叠部分。
+    返回按检索排名排序的段落文本列表。
+    """
+    passages = []  # [rank, source, last_chunk_index, text]
+    for rank, doc in enumerate(docs):
+        source = doc.metadata.get("source")
+        index = doc.metadata.get("chunk_index")
+        text = doc.page_content.strip()
+        for passage in passages:
+            if passage[1] != source:
+                continue
+            # 已有段落的结尾与当前块的开头重叠（或块序号相邻）时接在后面
+            overlap = _overlap_length(passage[3], text, max_overlap)
+            adjacent = index is not None and passage[2] is not None and index == passage[2] + 1
+            if overlap >= min_overlap or adjacent:
+                passage[3] = passage[3] + text[overlap:] if overlap >= min_overlap else passage[3] + "\n" + text
+                passage[2] = index
+                break
+            # 当前块的结尾与已有段落的开头重叠时接在前面
+            overlap = _overlap_length(text, passage[3], max_overlap)
+            if overlap >= min_overlap:
+                passage[3] = text + passage[3][overlap:]
+                break
+        else:
+            passages.append([rank, source, index, text])
+    return [passage[3] for passage in passages]
+
+
+class ContextPacker:
+    """
+    检索结果与 LLM 之间的上下文打包：
+    1. 合并同一来源中相邻/重叠的文本块，去掉重复的重叠部分
+    2. 按句切分（。！？和换行），删除与已保留句子近似重复的句子
+    3. 按与问题的相关度（字二元组重合度）加检索排名先验给句子打分，
+       在 token 预算内选出得分最高的句子，再按原文顺序拼接；相邻保留句子之间的分隔符
+       由它们在原文中的间隔决定，中间的句子被删掉时标题、列表等仍各占一行
+    预算按拼接后的完整文本计 token，超出时继续去掉得分最低的句子，保证不超过 token_budget。
+    """
+
+    def __init__(self, token_budget=1024, token_counter=None, duplicate_threshold=0.85):
+        self.token_budget = token_budget
+        self.count_tokens = token_counter or get_token_counter()
+        self.duplicate_threshold = duplicate_threshold
+
+    def pack(self, question, docs):
+        """返回 (打包后的上下文, 原始上下文 token 数, 打包后 token 数)。"""
+        original = "\n\n".join(doc.page_content for doc in docs)
+        original_tokens = self.count_tokens(original)
+
+        question_grams = _bigrams(question)
+        candidates = []  # (score, passage_rank, start, end, tokens)
+        kept_grams = []
+        passages = merge_adjacent(docs)
+        for passage_rank, passage in enumerate(passages):
+            for start, end in split_sentences(passage):
+                sentence = passage[start:end]
+                grams = _bigrams(sentence)
+                if any(len(grams & g) / len(grams | g) >= self.duplicate_threshold for g in kept_grams):
+                    continue
+                kept_grams.append(grams)
+                relevance = len(grams & question_grams) / len(question_grams)
+                score = relevance + 1.0 / (2 + passage_rank)
+                candidates.append((score, passage_rank, start, end, self.count_tokens(sentence)))
+
+        # 按得分从高到低选句；逐句累加的 token 数只是估计，拼接后的文本还要再核对一次
+        selected, used = [], 0
+        for candidate in sorted(candidates, key=lambda c: -c[0]):
+            if used + candidate[4] <= self.token_budget:
+                selected.append(candidate)
+                used += candidate[4]
+
+        context = self._join(passages, selected)
+        packed_tokens = self.count_tokens(context)
+        while packed_tokens > self.token_budget and selected:
+            selected.pop()  # selected 按得分降序，末尾得分最低
+            context = self._join(passages, selected)
+            packed_tokens = self.count_tokens(context)
+        return context, original_tokens, packed_tokens
+
+    @staticmethod
+    def _join(passages, selected):
+        """恢复原文顺序：同一段落的句子按原文间隔连接，段落之间空行分隔。"""
+        spans = {}
+        for _, passage_rank, start, end, _ in sorted(selected, key=lambda c: (c[1], c[2])):
+            spans.setdefault(passage_rank, []).append((start, end))
+        paragraphs = []
+        for passage_rank, sentence_spans in spans.items():
+            passage = passages[passage_rank]
+            pieces = [passage[sentence_spans[0][0]:sentence_spans[0][1]]]
+            for (_, previous_end), (start, end) in zip(sentence_spans, sentence_spans[1:]):
+                pieces.append(separator_between(passage, previous_end, start) + passage[start:end])
+            paragraphs.append("".join(pieces))
+        return "\n\n".join(paragraphs)
@@ -1,11 +1,71 @@
 # data_preparation.py
 import os
+import json
+import sys
+import time
 import shutil
-from langchain_community.document_loaders import TextLoader
-from langchain_text_splitters import CharacterTextSplitter
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_chroma import Chroma
-import chromadb # Import chromadb for direct client interaction if needed, though LangChain wrappers handle most.
+import hashlib
+import threading
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# LangChain / chromadb / torch 以及依赖它们的本项目模块都在用到时才导入（函数内 import），
+# 只调用 generate_rag_data 时（例如 rag_app 启动）不为它们付出导入时间。
+HEAVY_MODULES = (
+    "langchain_community.document_loaders",
+    "langchain_text_splitters",
+    "langchain_community.embeddings",
+    "embedding_cache",
+    "bm25_index",
+    "offset_splitter",
+    "dedup",
+    "embedding_server",
+)
+# 各向量存储后端额外需要的模块，预热时只导入所选后端的
+VECTOR_BACKEND_MODULES = {
+    "chroma": ("langchain_chroma", "chromadb"),
+    "numpy": ("numpy_store",),
+    "numpy-int8": ("numpy_store",),
+}
+# 嵌入模型的推理库，通常是启动耗时的大头，单独计时
+EMBEDDING_BACKEND_MODULES = {
+    "torch": ("torch", "sentence_transformers"),
+    "onnx": ("onnxruntime", "transformers", "onnx_embeddings"),
+    "onnx-int8": ("onnxruntime", "transformers", "onnx_embeddings"),
+    "onnx-fp32": ("onnxruntime", "transformers", "onnx_embeddings"),
+}
+
+def _import_timed(names, skip_missing=False):
+    timings = {}
+    for name in names:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            if not skip_missing:
+                raise
+            continue
+        timings[name] = time.perf_counter() - start
+    return timings
+
+def preload_modules(backend="chroma"):
+    """
+    提前导入延迟导入的模块（后台预热时调用），向量存储相关的只导入 backend 需要的，
+    返回 {模块名: 导入耗时秒数}。嵌入推理库由 preload_embedding_modules 单独导入。
+    """
+    return _import_timed(HEAVY_MODULES + VECTOR_BACKEND_MODULES[backend])
+
+def preload_embedding_modules(backend=None):
+    """
+    导入嵌入后端（默认取环境变量 EMBEDDING_BACKEND）的推理库，返回 {模块名: 导入耗时秒数}。
+    使用共享嵌入服务时本进程不加载模型，直接返回空字典；没有安装的库跳过，
+    由加载模型时给出安装提示。
+    """
+    if os.getenv("EMBEDDING_SERVER_URL"):
+        return {}
+    backend = backend or os.getenv("EMBEDDING_BACKEND", "torch")
+    return _import_timed(EMBEDDING_BACKEND_MODULES.get(backend, ()), skip_missing=True)
 
 def generate_rag_data(file_path="knowledge_base.txt"):
     """
@@ -45,26 +105,235 @@ def generate_rag_data(file_path="knowledge_base.txt"):
         f.write(data)
     print(f"✅ 知识库数据已生成并保存到 {file_path}")
 
-def _get_embedding_function():
-    """Helper to load the embedding model."""
+EMBEDDING_MODEL_NAME = "BAAI/bge-small-zh"
+
+EMBEDDING_BACKENDS = ("torch", "onnx", "onnx-int8", "onnx-fp32")
+
+# 同一进程内按参数复用已加载的嵌入模型（预热线程加载后，建库和查询直接使用）
+_embedding_functions = {}
+_embedding_lock = threading.Lock()
+
+def _get_embedding_function(use_cache=True, use_server=True, backend=None):
+    """
+    Helper to load the embedding model.
+    use_cache=True 时用持久化的 EmbeddingCache 包装模型，已经嵌入过的文本不再重复计算。
+    设置了环境变量 EMBEDDING_SERVER_URL 时（且 use_server=True）不在本进程加载模型，
+    而是返回共享嵌入服务的客户端（见 embedding_server.py，缓存由服务端负责）。
+    backend（默认取环境变量 EMBEDDING_BACKEND，否则为 torch）为 onnx / onnx-int8 / onnx-fp32 时
+    使用 ONNX Runtime 推理（见 onnx_embeddings.py，onnx 即 onnx-int8），首次使用时自动导出模型。
+    """
+    backend = backend or os.getenv("EMBEDDING_BACKEND", "torch")
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"未知的嵌入后端: {backend}，可选 {EMBEDDING_BACKENDS}")
+    key = (use_cache, use_server, backend)
+    with _embedding_lock:
+        if key not in _embedding_functions:
+            _embedding_functions[key] = _load_embedding_function(use_cache, use_server, backend)
+        return _embedding_functions[key]
+
+def _load_embedding_function(use_cache, use_server, backend):
+    from embedding_cache import EmbeddingCache, CachedEmbeddings
+    from embedding_server import EmbeddingServerClient
+
+    server_url = os.getenv("EMBEDDING_SERVER_URL")
+    if use_server and server_url:
+        client = EmbeddingServerClient(server_url)
+        try:
+            print(f"✅ 已连接共享嵌入服务 {server_url}（模型 {client.health()['model']}）。")
+        except OSError as e:
+            print(f"❌ 无法连接嵌入服务 {server_url}: {e}")
+            print("请先运行 'python embedding_server.py' 启动服务，或取消设置 EMBEDDING_SERVER_URL。")
+            raise
+        return client
     try:
-        embeddings = HuggingFaceEmbeddings(
-            model_name="BAAI/bge-small-zh",
-            model_kwargs={'device': 'cpu'},
-            encode_kwargs={'normalize_embeddings': True}
-        )
-        print("✅ HuggingFace Embedding 模型 (BAAI/bge-small-zh) 加载成功。")
+        if backend == "torch":
+            from langchain_community.embeddings import HuggingFaceEmbeddings
+            embeddings = HuggingFaceEmbeddings(
+                model_name=EMBEDDING_MODEL_NAME,
+                model_kwargs={'device': 'cpu'},
+                encode_kwargs={'normalize_embeddings': True}
+            )
+            print("✅ HuggingFace Embedding 模型 (BAAI/bge-small-zh) 加载成功。")
+            cache_model_name = EMBEDDING_MODEL_NAME
+        else:
+            from onnx_embeddings import OnnxEmbeddings, ensure_onnx_model, DEFAULT_ONNX_DIR
+            quantized = backend != "onnx-fp32"
+            ensure_onnx_model(EMBEDDING_MODEL_NAME, DEFAULT_ONNX_DIR, quantized=quantized)
+            embeddings = OnnxEmbeddings(DEFAULT_ONNX_DIR, quantized=quantized)
+            print(f"✅ ONNX Runtime Embedding 模型 (BAAI/bge-small-zh, {backend}) 加载成功。")
+            # 量化后的向量与 PyTorch 的结果略有差异，缓存按后端区分
+            cache_model_name = f"{EMBEDDING_MODEL_NAME}:{backend}"
+        if use_cache:
+            embeddings = CachedEmbeddings(embeddings, EmbeddingCache(), model_name=cache_model_name, normalize=True)
         return embeddings
     except Exception as e:
         print(f"❌ 嵌入模型加载失败: {e}")
-        print("请确保已安装 'sentence-transformers' 库，并且网络连接正常以下载模型。")
+        print("请确保已安装 'sentence-transformers' 库（ONNX 后端需要 'onnxruntime' 和 'transformers'），"
+              "并且网络连接正常以下载模型。")
         raise
 
-def load_and_vectorize_data(file_path="knowledge_base.txt", persist_directory="./chroma_db", force_rebuild=False):
+MANIFEST_FILE = "index_manifest.json"
+
+def _load_and_split(file_path, splitter="character", dedup_threshold=0.9):
+    """
+    读取知识库文件并分割成文本块，去除近似重复的文本块（dedup_threshold=None 时不去重）。
+    重复块合并到先出现的规范块上，规范块元数据的 duplicate_sources 记录所有重复块的来源。
+    """
+    if not dedup_threshold:
+        return _split_file(file_path, splitter)
+    from dedup import deduplicate
+    # 内容完全相同的文本块也交给去重器，它们的来源同样记到规范块上
+    docs_by_id, stats = deduplicate(_split_chunks(file_path, splitter), dedup_threshold)
+    if stats["duplicates"]:
+        print(f"✅ 近似去重（阈值 {dedup_threshold}）：合并了 {stats['duplicates']} 个重复文本块，"
+              f"保留 {stats['kept']} 个。")
+    return docs_by_id
+
+def _split_file(file_path, splitter="character"):
+    """返回 {chunk_id: Document}，内容完全相同的文本块只保留第一个。"""
+    unique_docs = {}
+    for doc in _split_chunks(file_path, splitter):
+        unique_docs.setdefault(doc.metadata["chunk_id"], doc)
+    return unique_docs
+
+def _split_chunks(file_path, splitter="character"):
+    """
+    读取知识库文件并分割成文本块列表（保留内容重复的块），每个文本块带有基于内容哈希的 chunk_id。
+    splitter="offset" 时用 OffsetTextSplitter 通过 mmap 流式分割（按句子和章节标题切分，
+    元数据中记录 start_byte/end_byte/section），适合很大的知识库文件。
+    """
+    if splitter == "offset":
+        from offset_splitter import OffsetTextSplitter
+        docs = list(OffsetTextSplitter(chunk_size=500, chunk_overlap=50).split_documents(file_path))
+        print(f"✅ 文档流式分割后生成了 {len(docs)} 个文本块。")
+        if not docs:
+            raise ValueError("知识库文件为空或无法加载。")
+        return docs
+
+    from langchain_community.document_loaders import TextLoader
+    from langchain_text_splitters import CharacterTextSplitter
+    loader = TextLoader(file_path, encoding="utf-8")
+    documents = loader.load()
+    print(f"✅ 已加载 {len(documents)} 个文档。")
+    if documents:
+        print(f"   第一个文档内容（前200字符）:\n---START---\n{documents[0].page_content[:200]}...\n---END---")
+    else:
+        print("   ⚠️ 未加载到任何文档内容！请检查 'knowledge_base.txt' 文件。")
+        raise ValueError("知识库文件为空或无法加载。")
+
+    text_splitter = CharacterTextSplitter(chunk_size=500, chunk_overlap=50)
+    docs = text_splitter.split_documents(documents)
+    print(f"✅ 文档分割后生成了 {len(docs)} 个文本块。")
+    if docs:
+        print(f"   第一个文本块内容（前200字符）:\n---START---\n{docs[0].page_content[:200]}...\n---END---")
+    else:
+        print("   ❌ 未生成任何文本块！请检查文本分割器配置或文档内容。")
+        raise ValueError("文本分割失败，未生成任何文本块。")
+
+    # 以内容哈希作为 chunk_id：内容不变则 id 不变
+    for i, doc in enumerate(docs):
+        doc.metadata["chunk_id"] = _chunk_id(doc.page_content)
+        doc.metadata["chunk_index"] = i
+    return docs
+
+def _chunk_id(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _load_manifest(persist_directory):
+    manifest_path = os.path.join(persist_directory, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _save_manifest(persist_directory, file_path, docs_by_id):
+    """manifest 记录每个 chunk_id 及其元数据，增量更新时据此计算差异。"""
+    manifest = {
+        "source": os.path.abspath(file_path),
+        "chunks": {chunk_id: doc.metadata for chunk_id, doc in docs_by_id.items()},
+    }
+    manifest_path = os.path.join(persist_directory, MANIFEST_FILE)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+def _sync_incremental(vectorstore, file_path, persist_directory, manifest, splitter="character",
+                      dedup_threshold=0.9):
+    """
+    按 manifest 做增量同步：只嵌入新增/变化的文本块，删除已移除的文本块，
+    未变化的文本块只在元数据变化时更新元数据，不重新计算嵌入向量。
+    """
+    print(f"🔄 增量模式：正在对比 {file_path} 与 manifest ...")
+    docs_by_id = _load_and_split(file_path, splitter, dedup_threshold)
+    old_chunks = manifest.get("chunks", {})
+
+    added = [chunk_id for chunk_id in docs_by_id if chunk_id not in old_chunks]
+    removed = [chunk_id for chunk_id in old_chunks if chunk_id not in docs_by_id]
+    changed_meta = [
+        chunk_id for chunk_id, doc in docs_by_id.items()
+        if chunk_id in old_chunks and old_chunks[chunk_id] != doc.metadata
+    ]
+
+    if removed:
+        vectorstore.delete(ids=removed)
+    if added:
+        vectorstore.add_documents([docs_by_id[chunk_id] for chunk_id in added], ids=added)
+    if changed_meta:
+        # 只更新元数据，不触发嵌入计算
+        _update_metadatas(vectorstore, changed_meta, [docs_by_id[chunk_id].metadata for chunk_id in changed_meta])
+
+    _save_manifest(persist_directory, file_path, docs_by_id)
+
+    # BM25 索引与向量集合同步更新
+    from bm25_index import load_index
+    bm25 = load_index(persist_directory)
+    if bm25 is None:
+        load_bm25_index(persist_directory, vectorstore)
+    else:
+        for chunk_id in removed:
+            bm25.remove(chunk_id)
+        for chunk_id in added:
+            bm25.add(chunk_id, docs_by_id[chunk_id].page_content, docs_by_id[chunk_id].metadata)
+        for chunk_id in changed_meta:
+            bm25.update_metadata(chunk_id, docs_by_id[chunk_id].metadata)
+        bm25.save(persist_directory)
+
+    unchanged = len(docs_by_id) - len(added)
+    print(f"✅ 增量更新完成：新增 {len(added)}，删除 {len(removed)}，元数据更新 {len(changed_meta)}，未变化 {unchanged}。"
+          f"总计 {_count(vectorstore)} 个条目。")
+    return vectorstore
+
+def _count(vectorstore):
+    # NumpyVectorStore 有 count / update_metadatas；按属性判断，避免为 isinstance 导入 numpy_store
+    return vectorstore.count() if hasattr(vectorstore, "update_metadatas") else vectorstore._collection.count()
+
+def _update_metadatas(vectorstore, ids, metadatas):
+    if hasattr(vectorstore, "update_metadatas"):
+        vectorstore.update_metadatas(ids, metadatas)
+    else:
+        vectorstore._collection.update(ids=ids, metadatas=metadatas)
+
+DEFAULT_PERSIST_DIRECTORIES = {"chroma": "./chroma_db", "numpy": "./numpy_db", "numpy-int8": "./numpy_db_int8"}
+
+def load_and_vectorize_data(file_path="knowledge_base.txt", persist_directory=None, force_rebuild=False,
+                            incremental=False, splitter="character", dedup_threshold=0.9, backend="chroma"):
     """
     从文本文件加载数据，分割，并创建或加载Chroma向量存储。
     force_rebuild=True 会强制删除现有向量存储并重新创建。
+    incremental=True 会在已有向量存储上按文本块内容哈希做增量更新，
+    只嵌入新增或变化的文本块（需要向量存储目录中有 manifest）。
+    splitter="offset" 使用基于 mmap 的流式分割器（见 offset_splitter.py），
+    文本块元数据带有原文的字节区间和所属章节。
+    dedup_threshold 是近似去重的 Jaccard 相似度阈值（见 dedup.py），None 表示不去重。
+    backend="numpy" / "numpy-int8" 使用进程内的 NumpyVectorStore（见 numpy_store.py）代替 Chroma，
+    向量以 float32 或 int8 量化保存并通过 mmap 加载。persist_directory 默认按后端区分
+    （./chroma_db、./numpy_db 或 ./numpy_db_int8），不同的存储不会互相覆盖；
+    已有 NumPy 存储的 dtype 与 backend 不一致时会重建。
     """
+    if backend not in DEFAULT_PERSIST_DIRECTORIES:
+        raise ValueError(f"未知的向量存储后端: {backend}")
+    persist_directory = persist_directory or DEFAULT_PERSIST_DIRECTORIES[backend]
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"❌ 知识库文件 '{file_path}' 不存在。请先运行 generate_rag_data。")
 
@@ -77,6 +346,19 @@ def load_and_vectorize_data(file_path="knowledge_base.txt", persist_directory=".
                      not os.path.exists(persist_directory) or \
                      len(os.listdir(persist_directory)) == 0
 
+    # Incremental mode needs a manifest; stores created before manifests existed are rebuilt once
+    manifest = None
+    if incremental and not should_rebuild:
+        manifest = _load_manifest(persist_directory)
+        if manifest is None:
+            print(f"⚠️ {persist_directory} 中没有 manifest，无法增量更新，将完整重建一次。")
+            should_rebuild = True
+
+    if backend != "chroma":
+        dtype = "int8" if backend == "numpy-int8" else "float32"
+        return _load_numpy_store(file_path, persist_directory, embeddings, should_rebuild, manifest, dtype,
+                                 splitter, dedup_threshold)
+
     if should_rebuild:
         # If rebuilding, first clean up any existing directory
         if os.path.exists(persist_directory):
@@ -85,30 +367,16 @@ def load_and_vectorize_data(file_path="knowledge_base.txt", persist_directory=".
             print("✅ 旧目录删除成功。")
 
         print(f"🔄 正在从 {file_path} 读取文档并创建新的向量存储...")
-        loader = TextLoader(file_path, encoding="utf-8")
-        documents = loader.load()
-        print(f"✅ 已加载 {len(documents)} 个文档。")
-        if documents:
-            print(f"   第一个文档内容（前200字符）:\n---START---\n{documents[0].page_content[:200]}...\n---END---")
-        else:
-            print("   ⚠️ 未加载到任何文档内容！请检查 'knowledge_base.txt' 文件。")
-            raise ValueError("知识库文件为空或无法加载。")
-
-        text_splitter = CharacterTextSplitter(chunk_size=500, chunk_overlap=50)
-        docs = text_splitter.split_documents(documents)
-        print(f"✅ 文档分割后生成了 {len(docs)} 个文本块。")
-        if docs:
-            print(f"   第一个文本块内容（前200字符）:\n---START---\n{docs[0].page_content[:200]}...\n---END---")
-        else:
-            print("   ❌ 未生成任何文本块！请检查文本分割器配置或文档内容。")
-            raise ValueError("文本分割失败，未生成任何文本块。")
+        docs_by_id = _load_and_split(file_path, splitter, dedup_threshold)
 
         print("🔄 正在创建 Chroma 向量存储并生成嵌入向量...")
+        from langchain_chroma import Chroma
         # IMPORTANT: This is the ONLY place Chroma.from_documents is called.
         # It creates the DB and implicitly persists it to persist_directory.
         vectorstore = Chroma.from_documents(
-            documents=docs,
+            documents=list(docs_by_id.values()),
             embedding=embeddings,
+            ids=list(docs_by_id.keys()),
             persist_directory=persist_directory,
             collection_metadata={"hnsw:space": "cosine"} # Match your insert_Vector.py
         )
@@ -117,10 +385,13 @@ def load_and_vectorize_data(file_path="knowledge_base.txt", persist_directory=".
         # Call persist() directly after from_documents.
         # While from_documents often implicitly persists, explicit call ensures consistency.
         vectorstore.persist()
+        _save_manifest(persist_directory, file_path, docs_by_id)
+        _build_bm25(docs_by_id).save(persist_directory)
         print(f"✅ 向量存储已持久化到 {persist_directory}。总计 {vectorstore._collection.count()} 个条目。")
         
     else: # should_rebuild is False, so try to load existing
         print(f"✅ 检测到 {persist_directory} 文件夹已存在，尝试从持久化数据加载。")
+        from langchain_chroma import Chroma
         try:
             # IMPORTANT: This is the ONLY place Chroma is loaded (not created from documents).
             vectorstore = Chroma(persist_directory=persist_directory, embedding_function=embeddings)
@@ -131,14 +402,251 @@ def load_and_vectorize_data(file_path="knowledge_base.txt", persist_directory=".
                 # This scenario (directory exists but empty) implies corruption or incomplete write
                 print(f"⚠️ {persist_directory} 文件夹存在但为空，或数据不完整。推荐重新生成。")
                 # Fallback: force a rebuild if loaded DB is empty
-                return load_and_vectorize_data(file_path, persist_directory, force_rebuild=True) 
+                return load_and_vectorize_data(file_path, persist_directory, force_rebuild=True, splitter=splitter,
+                                               dedup_threshold=dedup_threshold, backend=backend)
         except Exception as e:
             print(f"❌ 从持久化数据加载 ChromaDB 失败: {e}。推荐重新生成。")
             # Fallback: force a rebuild if loading fails
-            return load_and_vectorize_data(file_path, persist_directory, force_rebuild=True)
+            return load_and_vectorize_data(file_path, persist_directory, force_rebuild=True, splitter=splitter,
+                                               dedup_threshold=dedup_threshold, backend=backend)
+
+        if manifest is not None:
+            vectorstore = _sync_incremental(vectorstore, file_path, persist_directory, manifest, splitter,
+                                            dedup_threshold)
 
     return vectorstore
 
+def _load_numpy_store(file_path, persist_directory, embeddings, should_rebuild, manifest, dtype, splitter,
+                      dedup_threshold):
+    """NumpyVectorStore 后端：与 Chroma 分支相同的重建 / 加载 / 增量更新流程。"""
+    from numpy_store import NumpyVectorStore
+    if not should_rebuild:
+        vectorstore = NumpyVectorStore(embeddings, persist_directory, dtype=dtype)
+        if vectorstore.dtype != dtype:
+            print(f"⚠️ {persist_directory} 中的向量存储是 {vectorstore.dtype}，与请求的 {dtype} 不一致，将重新生成。")
+        elif vectorstore.count() > 0:
+            print(f"✅ 向量存储已从 {persist_directory} 映射加载（{vectorstore.dtype}，"
+                  f"{vectorstore.memory_bytes() / 1024 / 1024:.1f} MB）。总计 {vectorstore.count()} 个条目。")
+            if manifest is not None:
+                vectorstore = _sync_incremental(vectorstore, file_path, persist_directory, manifest, splitter,
+                                                dedup_threshold)
+            return vectorstore
+        else:
+            print(f"⚠️ {persist_directory} 中没有可用的向量数据，将重新生成。")
+
+    if os.path.exists(persist_directory):
+        print(f"🔄 检测到需要重建向量存储，正在删除旧目录: {persist_directory}")
+        shutil.rmtree(persist_directory)
+    print(f"🔄 正在从 {file_path} 读取文档并创建新的 NumPy 向量存储 ({dtype})...")
+    docs_by_id = _load_and_split(file_path, splitter, dedup_threshold)
+    vectorstore = NumpyVectorStore(embeddings, persist_directory, dtype=dtype)
+    vectorstore.add_documents(list(docs_by_id.values()), ids=list(docs_by_id.keys()))
+    _save_manifest(persist_directory, file_path, docs_by_id)
+    _build_bm25(docs_by_id).save(persist_directory)
+    print(f"✅ 向量存储已持久化到 {persist_directory}。总计 {vectorstore.count()} 个条目，"
+          f"向量占用 {vectorstore.memory_bytes() / 1024 / 1024:.1f} MB。")
+    return vectorstore
+
+def _build_bm25(docs_by_id):
+    from bm25_index import BM25Index
+    bm25 = BM25Index()
+    for chunk_id, doc in docs_by_id.items():
+        bm25.add(chunk_id, doc.page_content, doc.metadata)
+    return bm25
+
+def load_bm25_index(persist_directory=None, vectorstore=None):
+    """
+    加载与向量存储放在一起的 BM25 索引。索引文件不存在（例如旧版本建立的向量存储）时，
+    用向量存储中已有的文本块重建并保存。persist_directory 默认取向量存储所在目录。
+    """
+    persist_directory = persist_directory or getattr(vectorstore, "persist_directory", None) \
+        or getattr(vectorstore, "_persist_directory", None) or "./chroma_db"
+    from bm25_index import BM25Index, load_index
+    bm25 = load_index(persist_directory)
+    if bm25 is None and vectorstore is not None:
+        print("🔄 未找到 BM25 索引，正在从向量存储中的文本块重建...")
+        data = vectorstore.get(include=["documents", "metadatas"])
+        bm25 = BM25Index()
+        for chunk_id, text, metadata in zip(data["ids"], data["documents"], data["metadatas"]):
+            bm25.add(chunk_id, text, metadata)
+        bm25.save(persist_directory)
+        print(f"✅ BM25 索引重建完成，共 {len(bm25)} 个文本块。")
+    return bm25
+
+# ---------------- 大规模语料的流式、多进程向量化 ----------------
+
+_worker_embeddings = None
+
+def _init_embedding_worker(torch_threads):
+    """进程池初始化：每个工作进程只加载一次嵌入模型。"""
+    global _worker_embeddings
+    try:
+        import torch
+        # 多个进程同时跑 torch，限制每个进程的线程数避免 CPU 超额订阅
+        torch.set_num_threads(torch_threads)
+    except ImportError:
+        pass
+    # ONNX 后端读取同一个线程数设置
+    os.environ["EMBEDDING_THREADS"] = str(torch_threads)
+    _worker_embeddings = _get_embedding_function()
+
+def _embed_batch(ids, texts, metadatas):
+    return ids, texts, metadatas, _worker_embeddings.embed_documents(texts)
+
+def _iter_source_files(source_dir, extensions=(".txt", ".md")):
+    for root, _, files in os.walk(source_dir):
+        for name in sorted(files):
+            if name.endswith(extensions):
+                yield os.path.join(root, name)
+
+def _iter_chunk_batches(source_dir, batch_size, chunk_size, chunk_overlap, deduplicator=None):
+    """
+    用 OffsetTextSplitter 通过 mmap 流式分割每个文件，内存占用与文件大小无关。
+    元数据中的 start_byte/end_byte 指向源文件中的原文区间。
+    有 deduplicator 时，近似重复的文本块在嵌入之前就被丢弃，只记录来源引用。
+    """
+    from offset_splitter import OffsetTextSplitter
+    splitter = OffsetTextSplitter(chunk_size, chunk_overlap)
+    ids, texts, metadatas = [], [], []
+    for file_path in _iter_source_files(source_dir):
+        for chunk in splitter.iter_chunks(file_path):
+            text = chunk.text
+            chunk_id = _chunk_id(text)
+            metadata = chunk.metadata()
+            metadata["chunk_id"] = chunk_id
+            if deduplicator is not None and deduplicator.add(chunk_id, text, metadata) is not None:
+                continue
+            ids.append(chunk_id)
+            texts.append(text)
+            metadatas.append(metadata)
+            if len(ids) >= batch_size:
+                yield ids, texts, metadatas
+                ids, texts, metadatas = [], [], []
+    if ids:
+        yield ids, texts, metadatas
+
+def _merge_duplicate_sources(collection, bm25, deduplicator, batch_size=256):
+    """把重复块的来源引用写入已入库的规范块元数据（只更新元数据，不重新嵌入）。"""
+    canonical_ids = list(deduplicator.references)
+    for i in range(0, len(canonical_ids), batch_size):
+        ids = canonical_ids[i:i + batch_size]
+        data = collection.get(ids=ids, include=["metadatas"])
+        metadatas = [deduplicator.canonical_metadata(chunk_id, metadata)
+                     for chunk_id, metadata in zip(data["ids"], data["metadatas"])]
+        collection.update(ids=data["ids"], metadatas=metadatas)
+        for chunk_id, metadata in zip(data["ids"], metadatas):
+            bm25.update_metadata(chunk_id, metadata)
+
+def _peak_rss_mb():
+    """返回主进程与已结束子进程中的最大常驻内存 (MB)；resource 模块只在 Unix 上可用，其他平台返回 None。"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024  # macOS 单位为字节，Linux 为 KB
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return own, children
+
+def stream_vectorize_directory(source_dir, persist_directory="./chroma_db", collection_name="langchain",
+                               batch_size=64, workers=None, max_pending_batches=None, write_batch_size=256,
+                               chunk_size=500, chunk_overlap=50, dedup_threshold=0.9):
+    """
+    流式向量化整个目录：文件逐个通过 mmap 读取、按句子和章节即时分块，嵌入计算按 batch_size 分批
+    分发到进程池，向量按 write_batch_size 分批写入 Chroma。
+    同时在途的批次数量受 max_pending_batches 限制，因此内存占用与语料大小无关。
+    BM25 索引写入目录中的 SQLite 文件（见 bm25_index.SqliteBM25Index），不在内存中累积；
+    目录中已有 JSON 格式的 BM25 索引时先迁移到 SQLite。
+    去重需要在内存中保留每个规范块的 MinHash 签名（num_perm=128 时约 0.5 KB/块）和 LSH 分桶，
+    这是唯一随语料增长的内存开销，语料很大且不需要去重时可传 dedup_threshold=None。
+    近似重复的文本块（dedup_threshold，None 表示不去重）不做嵌入，
+    全部写入后再把重复块的来源引用合并到规范块的元数据中。
+    写入的集合与 load_and_vectorize_data 使用的默认集合相同，可直接用 Chroma 加载。
+    """
+    if not os.path.isdir(source_dir):
+        raise FileNotFoundError(f"❌ 语料目录 '{source_dir}' 不存在。")
+
+    workers = workers or os.cpu_count() or 1
+    max_pending_batches = max_pending_batches or workers * 2
+    torch_threads = max(1, (os.cpu_count() or 1) // workers)
+
+    import chromadb
+    from bm25_index import BM25_FILE, BM25Index, SqliteBM25Index
+    from dedup import MinHashDeduplicator
+
+    client = chromadb.PersistentClient(path=persist_directory)
+    collection = client.get_or_create_collection(collection_name, metadata={"hnsw:space": "cosine"})
+
+    write_buffer = {}
+    total_chunks = 0
+    bm25 = SqliteBM25Index(persist_directory)
+    legacy = BM25Index.load(persist_directory)
+    if legacy is not None:
+        for chunk_id, (text, metadata) in legacy.docs.items():
+            bm25.add(chunk_id, text, metadata, tf=legacy.doc_tf[chunk_id])
+        bm25.save()
+        os.remove(os.path.join(persist_directory, BM25_FILE))
+        del legacy
+    deduplicator = MinHashDeduplicator(dedup_threshold) if dedup_threshold else None
+
+    def flush():
+        if not write_buffer:
+            return
+        ids = list(write_buffer.keys())
+        texts, metadatas, vectors = zip(*write_buffer.values())
+        collection.upsert(ids=ids, documents=list(texts), metadatas=list(metadatas), embeddings=list(vectors))
+        bm25.save()
+        write_buffer.clear()
+
+    def collect(done_futures):
+        nonlocal total_chunks
+        for future in done_futures:
+            ids, texts, metadatas, vectors = future.result()
+            for chunk_id, text, metadata, vector in zip(ids, texts, metadatas, vectors):
+                # 同一批内相同内容的文本块 id 相同，字典去重保证 upsert 的 id 唯一
+                write_buffer[chunk_id] = (text, metadata, vector)
+                bm25.add(chunk_id, text, metadata)
+            total_chunks += len(ids)
+            if len(write_buffer) >= write_batch_size:
+                flush()
+
+    print(f"🔄 正在流式向量化 {source_dir}：{workers} 个进程，每批 {batch_size} 个文本块...")
+    start = time.perf_counter()
+    # spawn 避免在已加载 torch 的进程上 fork 导致死锁
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_embedding_worker, initargs=(torch_threads,)) as executor:
+        pending = set()
+        for ids, texts, metadatas in _iter_chunk_batches(source_dir, batch_size, chunk_size, chunk_overlap,
+                                                         deduplicator):
+            if len(pending) >= max_pending_batches:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(executor.submit(_embed_batch, ids, texts, metadatas))
+        done, _ = wait(pending)
+        collect(done)
+    flush()
+    if deduplicator is not None:
+        _merge_duplicate_sources(collection, bm25, deduplicator)
+    bm25.close()
+    elapsed = time.perf_counter() - start
+
+    own_rss, worker_rss = _peak_rss_mb() or (None, None)
+    stats = {
+        "chunks": total_chunks,
+        "seconds": elapsed,
+        "chunks_per_sec": total_chunks / elapsed if elapsed > 0 else 0.0,
+        "peak_rss_mb": own_rss,
+        "peak_worker_rss_mb": worker_rss,
+        "collection_count": collection.count(),
+        "duplicates": deduplicator.duplicates if deduplicator is not None else 0,
+    }
+    rss = f"峰值内存 主进程 {own_rss:.0f} MB，工作进程 {worker_rss:.0f} MB。" if own_rss is not None else ""
+    print(f"✅ 流式向量化完成：{stats['chunks']} 个文本块，耗时 {elapsed:.1f}s，"
+          f"{stats['chunks_per_sec']:.1f} chunks/sec；{rss}集合中共 {stats['collection_count']} 个条目，"
+          f"合并近似重复 {stats['duplicates']} 个。")
+    return stats
+
 if __name__ == "__main__":
     print("--- 正在执行 data_preparation.py ---")
     generate_rag_data()
@@ -0,0 +1,103 @@
+# dedup.py
+import re
+import json
+import zlib
+
+import numpy as np
+
+_NORMALIZE_RE = re.compile(r"[\s\W_]+")
+_PRIME = (1 << 31) - 1  # 哈希值限制在 31 位，a * x 不会超出 uint64
+
+
+def _choose_bands(num_perm, threshold):
+    """
+    选择 LSH 的分段数 b（每段 r 行）。候选阈值 (1/b)^(1/r) 取不超过 threshold 的最大值，
+    宁可多比较几个候选，也不漏掉真正的重复。
+    """
+    options = [(b, num_perm // b) for b in range(1, num_perm + 1) if num_perm % b == 0]
+    below = [option for option in options if (1 / option[0]) ** (1 / option[1]) <= threshold]
+    return max(below, key=lambda option: (1 / option[0]) ** (1 / option[1])) if below else options[-1]
+
+
+def source_reference(metadata):
+    """从文本块元数据中取出指向原文的引用（来源文件、块序号和字节区间）。"""
+    return {key: metadata[key] for key in ("source", "chunk_index", "start_byte", "end_byte") if key in metadata}
+
+
+class MinHashDeduplicator:
+    """
+    入库前的近似重复文本块检测：MinHash 签名 + LSH 分段分桶。
+    每个文本块按去掉空白和标点后的字符 shingle_size-gram 计算签名，
+    与同一个桶里已保留的文本块比较签名估计的 Jaccard 相似度，不低于 threshold 即判为重复。
+    先出现的文本块作为规范块 (canonical)，重复块的来源引用都记到规范块上。
+    """
+
+    def __init__(self, threshold=0.9, num_perm=128, shingle_size=5, seed=1):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.bands, self.rows = _choose_bands(num_perm, threshold)
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _PRIME, size=(num_perm, 1), dtype=np.uint64)
+        self._b = rng.integers(0, _PRIME, size=(num_perm, 1), dtype=np.uint64)
+        self._buckets = {}      # (分段序号, 分段签名) -> [chunk_id, ...]
+        self._signatures = {}   # 规范块 chunk_id -> 签名
+        self.references = {}    # 规范块 chunk_id -> 重复块的来源引用列表
+        self.duplicates = 0
+
+    def signature(self, text):
+        text = _NORMALIZE_RE.sub("", text.lower())
+        n = self.shingle_size
+        shingles = {text[i:i + n] for i in range(max(len(text) - n + 1, 1))}
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) & _PRIME for s in shingles),
+                             dtype=np.uint64, count=len(shingles))
+        return ((self._a * hashes + self._b) % _PRIME).min(axis=1)
+
+    def add(self, chunk_id, text, metadata=None):
+        """
+        登记一个文本块。是已保留文本块的近似重复时返回规范块的 chunk_id（并记录来源引用），
+        否则将其作为新的规范块保留并返回 None。
+        """
+        signature = self.signature(text)
+        keys = [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+        candidates = dict.fromkeys(cid for key in keys for cid in self._buckets.get(key, ()))
+        for candidate in candidates:
+            if np.mean(self._signatures[candidate] == signature) >= self.threshold:
+                self.references.setdefault(candidate, []).append(source_reference(metadata or {}))
+                self.duplicates += 1
+                return candidate
+
+        # 哈希值不超过 31 位，按 uint32 保存，内存减半
+        self._signatures[chunk_id] = signature.astype(np.uint32)
+        for key in keys:
+            self._buckets.setdefault(key, []).append(chunk_id)
+        return None
+
+    def canonical_metadata(self, chunk_id, metadata):
+        """返回规范块的元数据：duplicates 为重复块数，duplicate_sources 为它们来源引用的 JSON 字符串。"""
+        references = self.references.get(chunk_id)
+        if not references:
+            return metadata
+        metadata = dict(metadata)
+        metadata["duplicates"] = len(references)
+        metadata["duplicate_sources"] = json.dumps(references, ensure_ascii=False)
+        return metadata
+
+    def stats(self):
+        return {"kept": len(self._signatures), "duplicates": self.duplicates,
+                "bands": self.bands, "rows": self.rows, "threshold": self.threshold}
+
+
+def deduplicate(docs, threshold=0.9, **kwargs):
+    """
+    对 {chunk_id: Document} 或带 metadata["chunk_id"] 的 Document 列表去除近似重复，
+    返回 (只含规范块的 {chunk_id: Document}（保持原顺序）, 统计信息)。
+    列表中内容完全相同的文本块同样视为重复，来源引用记到规范块上。
+    """
+    deduplicator = MinHashDeduplicator(threshold, **kwargs)
+    pairs = docs.items() if isinstance(docs, dict) else ((doc.metadata["chunk_id"], doc) for doc in docs)
+    kept = {chunk_id: doc for chunk_id, doc in pairs
+            if deduplicator.add(chunk_id, doc.page_content, doc.metadata) is None}
+    for chunk_id, doc in kept.items():
+        doc.metadata = deduplicator.canonical_metadata(chunk_id, doc.metadata)
+    return kept, deduplicator.stats()
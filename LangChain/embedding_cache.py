@@ -0,0 +1,157 @@
+# embedding_cache.py
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./embedding_cache.sqlite3")
+DEFAULT_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "100000"))
+
+# SQLite 单条语句的参数个数有上限，批量查询时分段执行
+_SQL_BATCH = 500
+
+
+class EmbeddingCache:
+    """
+    基于 SQLite 的持久化嵌入向量缓存。
+    键为 (模型名, 是否归一化, 文本哈希)，超过 max_entries 时按最近使用时间淘汰。
+    多个进程可以共享同一个缓存文件（WAL 模式）。
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model_name, normalize, text):
+        raw = f"{model_name}\0{int(bool(normalize))}\0{text}".encode("utf-8")
+        return hashlib.sha256(raw).hexdigest()
+
+    def get_many(self, keys):
+        """返回 {key: vector}，只包含命中的键，并刷新它们的最近使用时间。"""
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), _SQL_BATCH):
+                part = keys[i:i + _SQL_BATCH]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", part
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+                if rows:
+                    hit_keys = [key for key, _ in rows]
+                    self._conn.execute(
+                        f"UPDATE embeddings SET last_used = ? WHERE key IN ({','.join('?' * len(hit_keys))})",
+                        [time.time(), *hit_keys],
+                    )
+            self._conn.commit()
+        return found
+
+    def put_many(self, items):
+        """写入 [(key, vector), ...]，必要时淘汰最久未使用的条目。"""
+        now = time.time()
+        rows = [(key, array("f", vector).tobytes(), now) for key, vector in items]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (overflow,)
+            )
+
+    def get_or_compute(self, model_name, normalize, texts, compute_fn):
+        """
+        对 texts 中未命中的文本调用 compute_fn 计算嵌入（同一批内重复文本只算一次），
+        并按原顺序返回所有向量。
+        """
+        keys = [self.make_key(model_name, normalize, text) for text in texts]
+        found = self.get_many(set(keys))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            vectors = compute_fn(list(missing.values()))
+            computed = [(key, [float(x) for x in vector]) for key, vector in zip(missing.keys(), vectors)]
+            self.put_many(computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    LangChain Embeddings 包装器：先查 EmbeddingCache，未命中的文本才交给底层模型。
+    """
+
+    def __init__(self, embeddings, cache, model_name, normalize):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_name = model_name
+        self.normalize = normalize
+
+    def embed_documents(self, texts):
+        return self.cache.get_or_compute(self.model_name, self.normalize, texts, self.embeddings.embed_documents)
+
+    def embed_query(self, text):
+        return self.cache.get_or_compute(
+            self.model_name, self.normalize, [text],
+            lambda texts: [self.embeddings.embed_query(texts[0])],
+        )[0]
+
+
+def cached_chroma_embedding_function(embedding_function, cache, model_name, normalize):
+    """
+    chromadb 嵌入函数包装器，可直接传给 create_collection(embedding_function=...)。
+    chromadb 只在需要时才导入，纯 LangChain 场景不依赖它。
+    """
+    import numpy as np
+    from chromadb.api.types import EmbeddingFunction, Documents
+
+    class CachedChromaEmbeddingFunction(EmbeddingFunction):
+        def __init__(self):
+            self.cache = cache
+            self.model_name = model_name
+            self.normalize = normalize
+
+        def __call__(self, input: Documents):
+            vectors = cache.get_or_compute(model_name, normalize, list(input), embedding_function)
+            return [np.asarray(vector, dtype=np.float32) for vector in vectors]
+
+    return CachedChromaEmbeddingFunction()
@@ -0,0 +1,192 @@
+# embedding_server.py
+import json
+import time
+import queue
+import argparse
+import threading
+import urllib.request
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+
+class MicroBatcher:
+    """
+    把多个调用方的小请求合并成一次模型调用：第一个请求到达后最多等待 max_wait_ms，
+    或凑满 max_batch_size 个文本就立即执行。模型只在批处理线程中调用，不需要额外加锁。
+    """
+
+    def __init__(self, embed_fn, max_batch_size=64, max_wait_ms=5):
+        self.embed_fn = embed_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = 0
+        self.batches = 0
+        self.texts = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, texts):
+        future = Future()
+        self._queue.put((list(texts), future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                size += len(item[0])
+            self._execute(batch)
+
+    def _execute(self, batch):
+        texts = [text for request_texts, _ in batch for text in request_texts]
+        try:
+            vectors = self.embed_fn(texts) if texts else []
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.requests += len(batch)
+        self.batches += 1
+        self.texts += len(texts)
+        start = 0
+        for request_texts, future in batch:
+            future.set_result([[float(x) for x in vector] for vector in vectors[start:start + len(request_texts)]])
+            start += len(request_texts)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "texts": self.texts,
+            "avg_batch_size": self.texts / self.batches if self.batches else 0.0,
+        }
+
+
+def make_handler(batcher, model_name):
+    class EmbeddingHandler(BaseHTTPRequestHandler):
+        """POST /embed {"texts": [...]} -> {"embeddings": [...]}；GET /health 返回模型名和批处理统计。"""
+
+        def do_GET(self):
+            if self.path != "/health":
+                self._send(404, {"error": "not found"})
+                return
+            self._send(200, {"model": model_name, "stats": batcher.stats()})
+
+        def do_POST(self):
+            if self.path != "/embed":
+                self._send(404, {"error": "not found"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                texts = body["texts"]
+                if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+                    raise ValueError("texts 必须是字符串列表")
+            except (ValueError, KeyError) as e:
+                self._send(400, {"error": str(e)})
+                return
+            try:
+                self._send(200, {"embeddings": batcher.submit(texts).result()})
+            except Exception as e:
+                self._send(500, {"error": str(e)})
+
+        def _send(self, status, payload):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return EmbeddingHandler
+
+
+class EmbeddingHTTPServer(ThreadingHTTPServer):
+    # 默认的 listen 队列只有 5，多个进程同时发请求时会被重置连接
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def serve(embeddings, model_name, host=DEFAULT_HOST, port=DEFAULT_PORT, max_batch_size=64, max_wait_ms=5):
+    batcher = MicroBatcher(embeddings.embed_documents, max_batch_size, max_wait_ms)
+    server = EmbeddingHTTPServer((host, port), make_handler(batcher, model_name))
+    print(f"✅ 嵌入服务已启动：http://{host}:{port}（模型 {model_name}，批大小 {max_batch_size}，"
+          f"最长等待 {max_wait_ms} ms）")
+    return server
+
+
+class EmbeddingServerClient(Embeddings):
+    """
+    嵌入服务的轻量客户端，实现 LangChain Embeddings 接口；
+    as_chroma_embedding_function() 返回可传给 chromadb 集合的嵌入函数。
+    """
+
+    def __init__(self, url=f"http://{DEFAULT_HOST}:{DEFAULT_PORT}", timeout=60):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def health(self):
+        with urllib.request.urlopen(f"{self.url}/health", timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        if not texts:
+            return []
+        request = urllib.request.Request(
+            f"{self.url}/embed",
+            data=json.dumps({"texts": texts}).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())["embeddings"]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def as_chroma_embedding_function(self):
+        """chromadb 只在需要时才导入，与 embedding_cache.cached_chroma_embedding_function 相同。"""
+        import numpy as np
+        from chromadb.api.types import EmbeddingFunction, Documents
+
+        client = self
+
+        class ServerChromaEmbeddingFunction(EmbeddingFunction):
+            def __call__(self, input: Documents):
+                return [np.asarray(vector, dtype=np.float32) for vector in client.embed_documents(list(input))]
+
+        return ServerChromaEmbeddingFunction()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本机共享的嵌入模型服务：所有进程共用一份模型，并发请求自动合批")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    from data_prep import _get_embedding_function, EMBEDDING_MODEL_NAME
+    server = serve(_get_embedding_function(use_server=False), EMBEDDING_MODEL_NAME,
+                   args.host, args.port, args.max_batch_size, args.max_wait_ms)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
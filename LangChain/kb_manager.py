@@ -0,0 +1,169 @@
+# kb_manager.py
+import os
+import shutil
+import hashlib
+import threading
+
+from data_prep import load_and_vectorize_data, load_bm25_index
+from rag_core import get_rag_chain
+
+READY_FILE = "READY"
+CURRENT_FILE = "CURRENT"
+SOURCE_FILE = "knowledge_base.txt"
+STORE_DIR = "store"
+
+
+def kb_content_hash(data):
+    """知识库内容的版本号：sha256 的前 16 位。"""
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+class KnowledgeBaseManager:
+    """
+    版本化的向量存储 + 后台重建 + 原子切换：
+    1. 每个版本以知识库内容哈希命名，保存在 root/<哈希前 16 位> 目录中，目录里先存一份知识库快照，
+       向量存储从快照构建（知识库文件在构建期间被改写也不会错配版本），建好后写入 READY 标记；
+       root/CURRENT 记录当前生效的版本，重启后直接加载，不会读到建了一半的目录
+    2. rebuild() 在后台线程中把新版本建到新目录，期间旧版本继续提供服务；
+       建好后一次赋值切换 (version, vectorstore, rag_chain)，正在进行的查询仍使用旧对象
+    3. RAG 链的答案缓存命名空间包含版本号，知识库变化后不会命中旧答案
+    4. 只保留当前和上一个版本的目录，更早的版本在切换后删除，答案缓存中这些版本的条目也一并删除
+    5. 被替换的 RAG 链在下一次切换时关闭（给正在进行的查询留出时间），
+       关闭时仍有查询未结束则由最后一个结束的查询关闭，每次重建不会多留一组数据库连接
+    """
+
+    def __init__(self, file_path="knowledge_base.txt", root="./kb_versions", backend="chroma", **chain_kwargs):
+        self.file_path = file_path
+        self.root = root
+        self.backend = backend
+        self.chain_kwargs = chain_kwargs
+        self.status = "idle"
+        self.error = None
+        self._active = None  # (version, vectorstore, rag_chain)，整体替换
+        self._retired = None  # 上一次切换时被替换的 RAG 链
+        self._lock = threading.RLock()
+        self._builder = None
+        self._pending = False
+        os.makedirs(root, exist_ok=True)
+
+    @property
+    def version(self):
+        return self._active[0] if self._active else None
+
+    def active(self):
+        """返回当前生效的 (version, vectorstore, rag_chain)；首次调用时加载或同步构建。"""
+        if self._active is None:
+            with self._lock:
+                if self._active is None:
+                    self._load_initial()
+        return self._active
+
+    def _snapshot(self):
+        with open(self.file_path, "rb") as f:
+            data = f.read()
+        return kb_content_hash(data), data
+
+    def _load_initial(self):
+        version, data = self._snapshot()
+        if self._is_ready(version):
+            self._activate(version)
+            return
+        current = self._read_current()
+        if current is not None and self._is_ready(current):
+            # 先用上次的版本提供服务，新版本在后台构建
+            self._activate(current)
+            self.rebuild()
+            return
+        self._activate(version, self._build(version, data))
+
+    def rebuild(self):
+        """在后台重建当前知识库文件对应的版本；已在构建时，结束后再构建一次。"""
+        with self._lock:
+            if self._builder is not None and self._builder.is_alive():
+                self._pending = True
+                return
+            self._builder = threading.Thread(target=self._rebuild_loop, name="kb-rebuild", daemon=True)
+            self._builder.start()
+
+    def _rebuild_loop(self):
+        while True:
+            self.status = "building"
+            try:
+                version, data = self._snapshot()
+                if version != self.version:
+                    vectorstore = None if self._is_ready(version) else self._build(version, data)
+                    self._activate(version, vectorstore)
+                self.status, self.error = "idle", None
+            except Exception as e:
+                self.status, self.error = "error", str(e)
+                print(f"❌ 知识库后台重建失败: {e}")
+            with self._lock:
+                if not self._pending:
+                    return
+                self._pending = False
+
+    def _build(self, version, data):
+        path = self._path(version)
+        if os.path.exists(path):
+            # 没有 READY 标记的目录是上次中断的构建，直接清掉重建
+            shutil.rmtree(path)
+        print(f"🔄 正在构建知识库版本 {version} ...")
+        os.makedirs(path)
+        with open(os.path.join(path, SOURCE_FILE), "wb") as f:
+            f.write(data)
+        vectorstore = load_and_vectorize_data(os.path.join(path, SOURCE_FILE),
+                                              persist_directory=os.path.join(path, STORE_DIR),
+                                              force_rebuild=True, backend=self.backend)
+        with open(os.path.join(path, READY_FILE), "w", encoding="utf-8") as f:
+            f.write(version)
+        return vectorstore
+
+    def _activate(self, version, vectorstore=None):
+        path = self._path(version)
+        if vectorstore is None:
+            vectorstore = load_and_vectorize_data(os.path.join(path, SOURCE_FILE),
+                                                  persist_directory=os.path.join(path, STORE_DIR), backend=self.backend)
+        bm25 = load_bm25_index(os.path.join(path, STORE_DIR), vectorstore=vectorstore)
+        rag_chain = get_rag_chain(vectorstore, bm25_index=bm25, kb_version=version, **self.chain_kwargs)
+        previous = self._active
+        self._active = (version, vectorstore, rag_chain)
+        self._write_current(version)
+        print(f"✅ 知识库已切换到版本 {version}。")
+        keep = {version, previous[0]} if previous else {version}
+        self._cleanup(keep)
+        self._retire(previous[2] if previous else None)
+        from rag_cache import prune_kb_versions
+        pruned = prune_kb_versions(keep)
+        if pruned:
+            print(f"🧹 已清理旧版本的缓存答案 {pruned} 条。")
+
+    def _retire(self, rag_chain):
+        """关闭上一次切换时被替换的链，刚被替换的链留到下一次切换再关闭。"""
+        retired, self._retired = self._retired, rag_chain
+        if retired is not None and hasattr(retired, "close"):
+            retired.close()
+
+    def _cleanup(self, keep):
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.isdir(path) and name not in keep:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _path(self, version):
+        return os.path.join(self.root, version)
+
+    def _is_ready(self, version):
+        return os.path.exists(os.path.join(self._path(version), READY_FILE))
+
+    def _read_current(self):
+        path = os.path.join(self.root, CURRENT_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+
+    def _write_current(self, version):
+        path = os.path.join(self.root, CURRENT_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(version)
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,223 @@
+# numpy_store.py
+import os
+import json
+import hashlib
+from typing import Any, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+SIDECAR_FILE = "numpy_store.json"
+VECTORS_FILE = "vectors.npy"
+SCALES_FILE = "scales.npy"
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def _quantize(matrix):
+    """按行对称量化到 int8：每行一个缩放系数 scale = max|v| / 127。"""
+    scales = np.maximum(np.abs(matrix).max(axis=1), 1e-12) / 127.0
+    return np.round(matrix / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    进程内的扁平向量库，适合几万个文本块的知识库：
+    1. 归一化后的 bge 向量保存为 .npy，加载时用 mmap 映射，启动几乎不耗时
+    2. dtype="int8" 时按行量化，向量内存约为 float32 的 1/4
+    3. 文本、元数据和 id 保存在 JSON 旁车文件中
+    4. 查询是精确 top-k：分块做一次矩阵-向量点积（余弦相似度），不建近似索引
+    每次写入后立即持久化（先写临时文件再替换）。
+    persist_directory 中已有存储时以其保存的 dtype 为准，调用方可比较 .dtype 判断是否与请求的一致。
+    """
+
+    def __init__(self, embedding: Embeddings, persist_directory: Optional[str] = None, dtype: str = "float32",
+                 block_size: int = 65536):
+        if dtype not in ("float32", "int8"):
+            raise ValueError("dtype 只能是 'float32' 或 'int8'。")
+        self._embedding = embedding
+        self.persist_directory = persist_directory
+        self.dtype = dtype
+        self.block_size = block_size
+        self._ids: List[str] = []
+        self._texts: List[str] = []
+        self._metadatas: List[dict] = []
+        self._index = {}
+        self._vectors = None
+        self._scales = None
+        if persist_directory and os.path.exists(os.path.join(persist_directory, SIDECAR_FILE)):
+            self._load()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def count(self):
+        return len(self._ids)
+
+    def memory_bytes(self):
+        """向量矩阵（含 int8 缩放系数）占用的字节数。"""
+        if self._vectors is None:
+            return 0
+        return self._vectors.nbytes + (self._scales.nbytes if self._scales is not None else 0)
+
+    # ---------------- 持久化 ----------------
+
+    def _load(self):
+        with open(os.path.join(self.persist_directory, SIDECAR_FILE), "r", encoding="utf-8") as f:
+            sidecar = json.load(f)
+        self.dtype = sidecar["dtype"]
+        self._ids = sidecar["ids"]
+        self._texts = sidecar["documents"]
+        self._metadatas = sidecar["metadatas"]
+        self._index = {chunk_id: i for i, chunk_id in enumerate(self._ids)}
+        if self._ids:
+            self._vectors = np.load(os.path.join(self.persist_directory, VECTORS_FILE), mmap_mode="r")
+            if self.dtype == "int8":
+                self._scales = np.load(os.path.join(self.persist_directory, SCALES_FILE), mmap_mode="r")
+
+    def _save(self):
+        if not self.persist_directory:
+            return
+        os.makedirs(self.persist_directory, exist_ok=True)
+        arrays = {VECTORS_FILE: self._vectors}
+        if self.dtype == "int8":
+            arrays[SCALES_FILE] = self._scales
+        for name, array in arrays.items():
+            if array is None:
+                continue
+            path = os.path.join(self.persist_directory, name)
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(path + ".tmp", path)
+        sidecar = {"dtype": self.dtype, "ids": self._ids, "documents": self._texts, "metadatas": self._metadatas}
+        path = os.path.join(self.persist_directory, SIDECAR_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(sidecar, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    # ---------------- 写入 ----------------
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        """添加文本；id 已存在时覆盖（upsert）。默认 id 为文本的 sha256，与 data_prep 的 chunk_id 一致。"""
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in texts]
+        vectors = _normalize(np.asarray(self._embedding.embed_documents(texts), dtype=np.float32))
+        self.delete([chunk_id for chunk_id in ids if chunk_id in self._index], persist=False)
+
+        if self.dtype == "int8":
+            vectors, scales = _quantize(vectors)
+            self._scales = scales if self._scales is None else np.concatenate([self._scales, scales])
+        self._vectors = vectors if self._vectors is None else np.concatenate([self._vectors, vectors])
+        for chunk_id, text, metadata in zip(ids, texts, metadatas):
+            self._index[chunk_id] = len(self._ids)
+            self._ids.append(chunk_id)
+            self._texts.append(text)
+            self._metadatas.append(metadata or {})
+        self._save()
+        return ids
+
+    def delete(self, ids: Optional[List[str]] = None, persist: bool = True, **kwargs: Any) -> Optional[bool]:
+        rows = sorted(self._index[chunk_id] for chunk_id in ids or () if chunk_id in self._index)
+        if not rows:
+            return True
+        keep = np.ones(len(self._ids), dtype=bool)
+        keep[rows] = False
+        self._vectors = self._vectors[keep]
+        if self._scales is not None:
+            self._scales = self._scales[keep]
+        removed = set(rows)
+        self._ids, self._texts, self._metadatas = (
+            [value for i, value in enumerate(column) if i not in removed]
+            for column in (self._ids, self._texts, self._metadatas)
+        )
+        self._index = {chunk_id: i for i, chunk_id in enumerate(self._ids)}
+        if persist:
+            self._save()
+        return True
+
+    def update_metadatas(self, ids: List[str], metadatas: List[dict]):
+        """只更新元数据，不重新计算嵌入向量。"""
+        for chunk_id, metadata in zip(ids, metadatas):
+            self._metadatas[self._index[chunk_id]] = metadata
+        self._save()
+
+    # ---------------- 读取 ----------------
+
+    def get(self, ids: Optional[List[str]] = None, include: Optional[List[str]] = None) -> dict:
+        """与 Chroma 的 get 返回格式相同：{"ids", "documents", "metadatas"}，不存在的 id 会被跳过。"""
+        rows = range(len(self._ids)) if ids is None else [self._index[i] for i in ids if i in self._index]
+        return {
+            "ids": [self._ids[row] for row in rows],
+            "documents": [self._texts[row] for row in rows],
+            "metadatas": [self._metadatas[row] for row in rows],
+        }
+
+    def get_by_ids(self, ids: List[str], /) -> List[Document]:
+        data = self.get(ids)
+        return [Document(id=chunk_id, page_content=text, metadata=metadata)
+                for chunk_id, text, metadata in zip(data["ids"], data["documents"], data["metadatas"])]
+
+    def _scores(self, query):
+        """分块计算所有向量与查询向量的点积，int8 块临时反量化，内存占用与块大小成正比。"""
+        scores = np.empty(len(self._ids), dtype=np.float32)
+        for start in range(0, len(self._ids), self.block_size):
+            block = self._vectors[start:start + self.block_size]
+            if self.dtype == "int8":
+                scores[start:start + len(block)] = (block.astype(np.float32) @ query) * \
+                    self._scales[start:start + len(block)]
+            else:
+                scores[start:start + len(block)] = block @ query
+        # int8 反量化和浮点误差会让余弦略超出 [-1, 1]（例如 1.0004），相关度分数要求在 [0, 1] 内
+        return np.clip(scores, -1.0, 1.0, out=scores)
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4,
+                                               filter: Optional[dict] = None, **kwargs: Any
+                                               ) -> List[Tuple[Document, float]]:
+        """返回 [(Document, 余弦相似度)]。filter 为元数据等值条件，例如 {"source": "kb.txt"}。"""
+        if not self._ids:
+            return []
+        query = _normalize(np.asarray(embedding, dtype=np.float32)[None, :])[0]
+        scores = self._scores(query)
+        if filter:
+            mask = np.array([all(metadata.get(key) == value for key, value in filter.items())
+                             for metadata in self._metadatas], dtype=bool)
+            scores[~mask] = -np.inf
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (Document(id=self._ids[row], page_content=self._texts[row], metadata=dict(self._metadatas[row])),
+             float(scores[row]))
+            for row in top if np.isfinite(scores[row])
+        ]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, **kwargs)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self._embedding.embed_query(query), k, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        # 分数已经是余弦相似度，映射到 [0, 1]
+        return lambda score: (score + 1) / 2
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   ids: Optional[List[str]] = None, persist_directory: Optional[str] = None,
+                   dtype: str = "float32", **kwargs: Any) -> "NumpyVectorStore":
+        store = cls(embedding, persist_directory=persist_directory, dtype=dtype)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
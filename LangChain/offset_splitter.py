@@ -0,0 +1,174 @@
+# offset_splitter.py
+import re
+import mmap
+import hashlib
+
+from langchain_core.documents import Document
+
+# 句子结束：中文句号/感叹号/问号，英文 .!? 后跟空白，或换行
+# （字节模式下多字节字符不能放进字符集，用分支匹配）
+_SENTENCE_END_RE = re.compile("。|！|？|[.!?](?=\\s)|\n".encode("utf-8"))
+# 标题行：markdown 的 # 标题，或整行加粗的 **1. 量子计算 (Quantum Computing):**
+_HEADING_RE = re.compile(rb"^[ \t]*(?:#{1,6}[ \t]+(.+?)|\*\*(.+?)\*\*)[ \t]*:?[ \t]*\r?$")
+_WHITESPACE = b" \t\r\n\x0b\x0c"
+
+
+def read_span(source, start, end):
+    """按字节偏移读取源文件中的一段文本，用于从元数据还原文本块的原文。"""
+    with open(source, "rb") as f:
+        f.seek(start)
+        return f.read(end - start).decode("utf-8")
+
+
+class OffsetChunk:
+    """
+    文本块只记录源文件和字节区间 [start, end)，文本在访问 .text 时才解码。
+    文件仍在映射中时直接从 mmap 切片，否则重新打开文件读取该区间。
+    """
+    __slots__ = ("source", "start", "end", "section", "index", "_mm")
+
+    def __init__(self, source, start, end, section, index, mm):
+        self.source = source
+        self.start = start
+        self.end = end
+        self.section = section
+        self.index = index
+        self._mm = mm
+
+    @property
+    def text(self):
+        if self._mm is not None and not self._mm.closed:
+            return self._mm[self.start:self.end].decode("utf-8")
+        return read_span(self.source, self.start, self.end)
+
+    def metadata(self):
+        return {
+            "source": self.source,
+            "chunk_index": self.index,
+            "start_byte": self.start,
+            "end_byte": self.end,
+            "section": self.section or "",
+        }
+
+    def to_document(self):
+        text = self.text
+        metadata = self.metadata()
+        metadata["chunk_id"] = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return Document(page_content=text, metadata=metadata)
+
+
+class OffsetTextSplitter:
+    """
+    基于内存映射的流式文本分割器，适合 GB 级别的知识库文件：
+    1. 文件通过 mmap 按需分页读取，正则直接在映射上扫描，不把文件读入内存
+    2. 按句（。！？ 和换行）切分，句子按顺序拼成不超过 chunk_size 个字符的文本块，
+       块之间以整句重叠，重叠部分不超过 chunk_overlap 个字符
+    3. 标题行（# 标题 或 **1. 量子计算** 这样的加粗行）是硬边界：文本块不跨越章节，
+       标题文本记录在之后每个文本块的 section 元数据中
+    4. 文本块只产出字节偏移，元数据中的 start_byte/end_byte 指向源文件中的原文区间
+    超过 chunk_size 且没有句子边界的超长片段，按 UTF-8 字符边界硬切。
+    """
+
+    def __init__(self, chunk_size=500, chunk_overlap=50):
+        if chunk_overlap >= chunk_size:
+            raise ValueError("chunk_overlap 必须小于 chunk_size。")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+
+    def iter_chunks(self, file_path):
+        """产出 OffsetChunk。文本块在迭代期间可以直接从映射读取文本。"""
+        with open(file_path, "rb") as f:
+            if f.seek(0, 2) == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield from self._split(file_path, mm)
+
+    def split_documents(self, file_path):
+        """产出带 chunk_id 和偏移元数据的 Document。"""
+        for chunk in self.iter_chunks(file_path):
+            yield chunk.to_document()
+
+    def _split(self, file_path, mm):
+        segments = []  # 当前文本块中的句子区间 (start, end)
+        size = 0       # 当前文本块从第一句开头到最后一句结尾的字符数（含句间空白）
+        index = 0
+        section = None
+
+        def chars(start, end):
+            return len(mm[start:end].decode("utf-8"))
+
+        def emit():
+            nonlocal index
+            chunk = OffsetChunk(file_path, segments[0][0], segments[-1][1], section, index, mm)
+            index += 1
+            return chunk
+
+        for start, end, heading in self._iter_segments(mm):
+            if heading is not None:
+                # 新章节开始：输出当前文本块，不把上一章节的句子带入重叠
+                if segments:
+                    yield emit()
+                segments, size = [], 0
+                section = heading
+            if segments and size + chars(segments[-1][1], end) > self.chunk_size:
+                yield emit()
+                # 从末尾保留整句作为下一个文本块的重叠部分
+                last_end = segments[-1][1]
+                overlap = []
+                for segment in reversed(segments):
+                    if chars(segment[0], last_end) > self.chunk_overlap:
+                        break
+                    overlap.insert(0, segment)
+                segments = overlap
+                size = chars(segments[0][0], last_end) if segments else 0
+                if segments and size + chars(last_end, end) > self.chunk_size:
+                    segments, size = [], 0
+            size = size + chars(segments[-1][1], end) if segments else chars(start, end)
+            segments.append((start, end))
+        if segments:
+            yield emit()
+
+    def _iter_segments(self, mm):
+        """产出去掉首尾空白的句子区间 (start, end, 标题文本或 None)。"""
+        max_bytes = self.chunk_size  # 按字节硬切，切出的片段一定不超过 chunk_size 个字符
+        length = len(mm)
+        line_start = 0
+        while line_start < length:
+            line_end = mm.find(b"\n", line_start)
+            line_end = length if line_end == -1 else line_end + 1
+            heading = _HEADING_RE.match(mm[line_start:line_end].rstrip(b"\n")) \
+                if line_end - line_start <= max_bytes else None
+            if heading is not None:
+                title = (heading.group(1) or heading.group(2)).decode("utf-8").strip().rstrip(":：").strip()
+                span = self._strip(mm, line_start, line_end)
+                if span is not None:
+                    yield span[0], span[1], title
+            else:
+                position = line_start
+                for match in _SENTENCE_END_RE.finditer(mm, line_start, line_end):
+                    yield from self._bounded(mm, position, match.end(), max_bytes)
+                    position = match.end()
+                if position < line_end:
+                    yield from self._bounded(mm, position, line_end, max_bytes)
+            line_start = line_end
+
+    def _bounded(self, mm, start, end, max_bytes):
+        span = self._strip(mm, start, end)
+        if span is None:
+            return
+        start, end = span
+        while end - start > max_bytes:
+            cut = start + max_bytes
+            while mm[cut] & 0xC0 == 0x80:  # 不在多字节字符中间切开
+                cut -= 1
+            yield start, cut, None
+            start = cut
+        yield start, end, None
+
+    @staticmethod
+    def _strip(mm, start, end):
+        while start < end and mm[start] in _WHITESPACE:
+            start += 1
+        while end > start and mm[end - 1] in _WHITESPACE:
+            end -= 1
+        return (start, end) if start < end else None
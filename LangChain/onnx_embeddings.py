@@ -0,0 +1,174 @@
+# onnx_embeddings.py
+import os
+import time
+import argparse
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_ONNX_DIR = os.getenv("ONNX_MODEL_DIR", "./onnx_bge_small_zh")
+FP32_FILE = "model.onnx"
+INT8_FILE = "model.int8.onnx"
+
+
+def export_onnx(model_name, output_dir=DEFAULT_ONNX_DIR, quantize=True, opset=14):
+    """
+    把 HuggingFace 上的 bge 模型导出为 ONNX（动态 batch 和序列长度），并保存分词器。
+    quantize=True 时再做一次动态 int8 量化（只量化权重，激活在运行时量化），生成 model.int8.onnx。
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name)
+    model.eval()
+    tokenizer.save_pretrained(output_dir)
+
+    inputs = tokenizer(["量子计算利用量子力学现象。"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in inputs]
+    fp32_path = os.path.join(output_dir, FP32_FILE)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(inputs[name] for name in input_names),
+            fp32_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes={**{name: {0: "batch", 1: "sequence"} for name in input_names},
+                          "last_hidden_state": {0: "batch", 1: "sequence"}},
+            opset_version=opset,
+        )
+    print(f"✅ ONNX 模型已导出到 {fp32_path}")
+
+    if quantize:
+        quantize_onnx(output_dir)
+    return output_dir
+
+
+def quantize_onnx(output_dir=DEFAULT_ONNX_DIR):
+    """对已导出的 model.onnx 做动态 int8 量化（只量化权重，激活在运行时量化），生成 model.int8.onnx。"""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    int8_path = os.path.join(output_dir, INT8_FILE)
+    quantize_dynamic(os.path.join(output_dir, FP32_FILE), int8_path, weight_type=QuantType.QInt8)
+    print(f"✅ int8 动态量化模型已保存到 {int8_path}")
+    return int8_path
+
+
+def ensure_onnx_model(model_name, output_dir=DEFAULT_ONNX_DIR, quantized=True):
+    """确保后端要加载的模型文件存在：没有 model.onnx 时导出，只缺 model.int8.onnx 时只做量化。"""
+    if not os.path.exists(os.path.join(output_dir, FP32_FILE)):
+        print(f"🔄 未找到 ONNX 模型，正在导出到 {output_dir} ...")
+        export_onnx(model_name, output_dir, quantize=quantized)
+    elif quantized and not os.path.exists(os.path.join(output_dir, INT8_FILE)):
+        print(f"🔄 未找到 int8 量化模型，正在量化 {output_dir} 中的 {FP32_FILE} ...")
+        quantize_onnx(output_dir)
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    用 ONNX Runtime 在 CPU 上运行 bge 模型，实现 LangChain Embeddings 接口：
+    1. 与 HuggingFaceEmbeddings(normalize_embeddings=True) 相同的输出约定：取 [CLS] 向量再做 L2 归一化，
+       已有的 Chroma 集合不用重建
+    2. 文本只分词一次，按 token 长度排序后分批，每批只填充到批内最长的长度，几乎没有无效计算
+    3. intra_op_threads 控制单次推理的线程数（默认取环境变量 EMBEDDING_THREADS，否则等于 CPU 核数）
+    """
+
+    def __init__(self, model_dir=DEFAULT_ONNX_DIR, quantized=True, batch_size=32, max_length=512,
+                 intra_op_threads=None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.model_dir = model_dir
+        self.quantized = quantized
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads or int(os.getenv("EMBEDDING_THREADS", 0)) or os.cpu_count() or 1
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        path = os.path.join(model_dir, INT8_FILE if quantized else FP32_FILE)
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self._input_names = [i.name for i in self.session.get_inputs()]
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        if not texts:
+            return []
+        encoded = self.tokenizer(texts, truncation=True, max_length=self.max_length)
+        order = sorted(range(len(texts)), key=lambda i: len(encoded["input_ids"][i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            for i, vector in zip(batch, self._run(encoded, batch)):
+                vectors[i] = vector.tolist()
+        return vectors
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def _run(self, encoded, batch):
+        length = max(len(encoded["input_ids"][i]) for i in batch)
+        feeds = {}
+        for name in self._input_names:
+            pad = self.tokenizer.pad_token_id if name == "input_ids" else 0
+            array = np.full((len(batch), length), pad, dtype=np.int64)
+            for row, i in enumerate(batch):
+                values = encoded[name][i] if name in encoded else [0] * len(encoded["input_ids"][i])
+                array[row, :len(values)] = values
+            feeds[name] = array
+        hidden = self.session.run(["last_hidden_state"], feeds)[0]
+        cls = hidden[:, 0]
+        return cls / np.maximum(np.linalg.norm(cls, axis=1, keepdims=True), 1e-12)
+
+
+def parity_check(reference, candidate, texts):
+    """两个嵌入后端在同一批文本上的余弦相似度（逐条），返回 (最小值, 平均值)。"""
+    a = np.asarray(reference.embed_documents(texts), dtype=np.float32)
+    b = np.asarray(candidate.embed_documents(texts), dtype=np.float32)
+    a /= np.linalg.norm(a, axis=1, keepdims=True)
+    b /= np.linalg.norm(b, axis=1, keepdims=True)
+    cosine = (a * b).sum(axis=1)
+    return float(cosine.min()), float(cosine.mean())
+
+
+def benchmark(embeddings, texts, repeats=3):
+    """返回每秒嵌入的文本数（取 repeats 次中最快的一次，先预热一次）。"""
+    embeddings.embed_documents(texts[:8])
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        embeddings.embed_documents(texts)
+        best = min(best, time.perf_counter() - start)
+    return len(texts) / best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="导出 bge 模型为 ONNX / int8，并与 PyTorch 后端比较一致性和吞吐量")
+    parser.add_argument("command", choices=["export", "compare"])
+    parser.add_argument("--model-dir", default=DEFAULT_ONNX_DIR)
+    parser.add_argument("--knowledge-base", default="knowledge_base.txt", help="compare 时用作测试文本的知识库文件")
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    from data_prep import EMBEDDING_MODEL_NAME, _get_embedding_function, _split_file
+    if args.command == "export":
+        export_onnx(EMBEDDING_MODEL_NAME, args.model_dir)
+    else:
+        ensure_onnx_model(EMBEDDING_MODEL_NAME, args.model_dir, quantized=True)
+        texts = [doc.page_content for doc in _split_file(args.knowledge_base, splitter="offset").values()]
+        texts = (texts * (256 // max(len(texts), 1) + 1))[:256]
+        # 参照后端不走缓存，否则测到的是缓存读取速度
+        reference = _get_embedding_function(use_cache=False, use_server=False, backend="torch")
+        results = {"torch": benchmark(reference, texts)}
+        for quantized in (False, True):
+            name = "onnx-int8" if quantized else "onnx-fp32"
+            candidate = OnnxEmbeddings(args.model_dir, quantized=quantized, intra_op_threads=args.threads)
+            min_cos, mean_cos = parity_check(reference, candidate, texts)
+            results[name] = benchmark(candidate, texts)
+            print(f"{name}: 余弦一致性 最小 {min_cos:.4f} / 平均 {mean_cos:.4f}")
+        for name, throughput in results.items():
+            print(f"{name:>10}: {throughput:8.1f} texts/sec ({throughput / results['torch']:.2f}x)")
@@ -1,9 +1,15 @@
 # app.py
+import time
+_import_start = time.perf_counter()
 import streamlit as st
 import os
-from data_prep import generate_rag_data, load_and_vectorize_data
-from rag_core import get_rag_chain, get_no_rag_chain, get_dashscope_api_key
-from langchain_core.messages import HumanMessage
+import queue
+import threading
+# 这些模块只在顶层导入标准库；LangChain、chromadb、torch 和嵌入模型在后台预热线程中加载
+from data_prep import generate_rag_data
+from rag_core import get_dashscope_api_key
+from startup_profile import StartupProfiler, start_warm_up
+_import_seconds = time.perf_counter() - _import_start
 
 # Check DashScope API key
 try:
@@ -17,29 +23,53 @@ st.set_page_config(layout="wide", page_title="RAG vs. No RAG 对比工具")
 st.title("💡 RAG vs. No RAG 对比工具")
 st.write("输入一个问题，点击查询，查看有RAG（检索增强生成）和没有RAG的语言模型如何回答。")
 
-# --- Generate RAG data and initialize vector store ---
+# Cache resources to avoid re-loading on every interaction
+# 嵌入模型、向量存储和 LLM 客户端在后台线程中预热，页面立即渲染；查询时等待 ready 完成。
+# 向量存储由 KnowledgeBaseManager 按知识库内容哈希分版本管理，所有会话共享同一个实例。
+@st.cache_resource
+def get_warm_up():
+    profiler = StartupProfiler()
+    profiler.record("import rag_app modules", _import_seconds)
+    # VECTOR_BACKEND=numpy / numpy-int8 时使用进程内的 NumPy 向量存储代替 Chroma
+    return profiler, start_warm_up(profiler, backend=os.getenv("VECTOR_BACKEND", "chroma"))
+
+profiler, ready = get_warm_up()
+
+def wait_until_ready():
+    """
+    等待后台预热完成并返回 (kb_manager, no_rag_chain)。预热失败时显示错误并结束本次运行，
+    同时清除缓存的 Future，下一次交互会重新预热。
+    """
+    try:
+        if not ready.done():
+            with st.spinner("正在加载嵌入模型和向量存储...这可能需要一些时间。"):
+                return ready.result()
+        return ready.result()
+    except Exception as e:
+        get_warm_up.clear()
+        st.error(f"资源加载失败: {e}。请检查配置后重试，下次操作时会重新加载。")
+        st.stop()
+
+# --- Generate RAG data and rebuild the vector store in the background ---
 st.sidebar.header("数据管理")
 if st.sidebar.button("生成/更新 RAG 知识库数据"):
     generate_rag_data()
-    st.sidebar.success("知识库数据已生成/更新。")
-    # After generating data, we also want to rebuild the vector store
-    # So we'll force a reload by clearing the cache
-    if 'vectorstore' in st.session_state:
-        del st.session_state['vectorstore']
-    # Add a message to prompt user to refresh if needed
-    st.sidebar.warning("知识库数据更新后，请刷新页面或等待自动重新加载以重建向量存储。")
-
-# Cache resources to avoid re-loading on every interaction
-@st.cache_resource
-def load_resources():
-    st.info("正在加载或创建向量存储...这可能需要一些时间。")
-    vectorstore_instance = load_and_vectorize_data()
-    rag_chain_instance = get_rag_chain(vectorstore_instance)
-    no_rag_chain_instance = get_no_rag_chain()
-    st.success("资源加载完成！")
-    return vectorstore_instance, rag_chain_instance, no_rag_chain_instance
-
-vectorstore, rag_chain, no_rag_chain = load_resources()
+    kb_manager, _ = wait_until_ready()
+    kb_manager.rebuild()
+    st.sidebar.success("知识库数据已生成/更新，正在后台重建向量存储，完成前继续使用当前版本回答。")
+if not ready.done():
+    st.sidebar.info("🔄 嵌入模型和向量存储正在后台加载...")
+elif ready.exception() is not None:
+    # 清除缓存，下一次交互时重新预热
+    get_warm_up.clear()
+    st.sidebar.error(f"资源加载失败: {ready.exception()}。下次操作时会重新加载。")
+else:
+    kb_manager, _ = ready.result()
+    st.sidebar.caption(f"知识库版本：{kb_manager.version}")
+    if kb_manager.status == "building":
+        st.sidebar.info("🔄 新版本正在后台构建...")
+    elif kb_manager.status == "error":
+        st.sidebar.error(f"后台重建失败，仍使用当前版本：{kb_manager.error}")
 
 
 # --- User Input ---
@@ -53,9 +83,57 @@ st.session_state.user_question = user_question_input # 更新 session_state
 # 添加查询按钮
 query_button = st.button("查询")
 
+def rag_events(rag_chain, question):
+    """RAG 链的事件流；没有 stream() 的 RetrievalQA（use_cache=False）一次性产出全部结果。"""
+    from rag_cache import CachedRetrievalQA
+    if isinstance(rag_chain, CachedRetrievalQA):
+        yield from rag_chain.stream({"query": question})
+        return
+    # 确保rag_chain的输入是字典，并且键与链期望的一致 (通常是 'query')
+    response = rag_chain.invoke({"query": question})
+    yield "sources", response.get("source_documents", [])
+    yield "token", response["result"]
+    yield "done", response
+
+def llm_events(llm, question):
+    from langchain_core.messages import HumanMessage
+    for chunk in llm.stream([HumanMessage(content=question)]):
+        if chunk.content:
+            yield "token", chunk.content
+    yield "done", None
+
+def run_concurrently(streams):
+    """
+    每个事件流在自己的线程中运行，事件汇总到队列后在脚本线程中依次产出 (名称, 事件, 数据)，
+    流结束时产出 (名称, "end", None)。Streamlit 元素只能在脚本线程中更新，所以工作线程只负责入队。
+    """
+    events = queue.Queue()
+
+    def worker(name, stream):
+        try:
+            for event, payload in stream:
+                events.put((name, event, payload))
+        except Exception as e:
+            events.put((name, "error", e))
+        finally:
+            events.put((name, "end", None))
+
+    for name, stream in streams.items():
+        threading.Thread(target=worker, args=(name, stream), daemon=True).start()
+    remaining = len(streams)
+    while remaining:
+        item = events.get()
+        if item[1] == "end":
+            remaining -= 1
+        yield item
+
 # 只有当点击了查询按钮或用户在输入框按了回车键（这里仅响应按钮）
 # 或者当页面首次加载且user_question_input有值时，为了初始化显示
 if query_button and st.session_state.user_question:
+    kb_manager, no_rag_chain = wait_until_ready()
+    # 每次查询都取当前生效的版本，后台重建完成后自动使用新版本
+    kb_version, vectorstore, rag_chain = kb_manager.active()
+
     st.markdown("---")
     st.subheader("回答对比")
 
@@ -63,29 +141,52 @@ if query_button and st.session_state.user_question:
 
     with col1:
         st.info("🚀 **有 RAG 的回答**")
-        with st.spinner("RAG 正在思考中..."):
-            try:
-                # 确保rag_chain的输入是字典，并且键与链期望的一致 (通常是 'query')
-                rag_response = rag_chain.invoke({"query": st.session_state.user_question})
-                st.write(rag_response["result"])
+        rag_answer = st.empty()
+        rag_caption = st.empty()
+        rag_sources = st.container()
+    with col2:
+        st.warning("🧠 **没有 RAG 的回答 (纯 LLM)**")
+        llm_answer = st.empty()
+        llm_caption = st.empty()
+
+    # 两个链并发执行，答案逐 token 显示；检索完成后立即显示来源文档，不等生成结束
+    question = st.session_state.user_question
+    labels = {"rag": "RAG", "llm": "纯 LLM"}
+    placeholders = {"rag": rag_answer, "llm": llm_answer}
+    captions = {"rag": rag_caption, "llm": llm_caption}
+    answers = {"rag": "", "llm": ""}
+    first_token, failed, notes = {}, set(), {"rag": ""}
+    rag_answer.markdown("_RAG 正在检索..._")
+    llm_answer.markdown("_纯 LLM 正在思考中..._")
+    start = time.perf_counter()
+
+    for name, event, payload in run_concurrently({"rag": rag_events(rag_chain, question),
+                                                   "llm": llm_events(no_rag_chain, question)}):
+        if event == "sources":
+            with rag_sources:
                 st.markdown("---")
                 st.markdown("**检索到的相关上下文:**")
-                if "source_documents" in rag_response and rag_response["source_documents"]:
-                    for i, doc in enumerate(rag_response["source_documents"]):
+                if payload:
+                    for i, doc in enumerate(payload):
                         st.text(f"文档 {i+1}: {doc.page_content[:200]}...")
                 else:
                     st.text("未检索到相关文档。")
-            except Exception as e:
-                st.error(f"RAG 回答出错: {e}")
-
-    with col2:
-        st.warning("🧠 **没有 RAG 的回答 (纯 LLM)**")
-        with st.spinner("纯 LLM 正在思考中..."):
-            try:
-                no_rag_response = no_rag_chain.invoke([HumanMessage(content=st.session_state.user_question)])
-                st.write(no_rag_response.content)
-            except Exception as e:
-                st.error(f"纯 LLM 回答出错: {e}")
+            if not answers["rag"]:
+                rag_answer.markdown("_RAG 正在思考中..._")
+        elif event == "token":
+            first_token.setdefault(name, time.perf_counter() - start)
+            answers[name] += payload
+            placeholders[name].markdown(answers[name] + "▌")
+        elif event == "done" and name == "rag" and "context_tokens_saved" in payload:
+            notes["rag"] = f"上下文 {payload['context_tokens']} tokens，打包节省 {payload['context_tokens_saved']} tokens；"
+        elif event == "error":
+            failed.add(name)
+            placeholders[name].error(f"{labels[name]} 回答出错: {payload}")
+        elif event == "end" and name not in failed:
+            placeholders[name].markdown(answers[name])
+            captions[name].caption(f"{notes.get(name, '')}首个 token {first_token.get(name, 0) * 1000:.0f} ms，"
+                                   f"总耗时 {time.perf_counter() - start:.1f} s")
+    st.caption(f"两个回答并发生成，总耗时 {time.perf_counter() - start:.1f} s")
 
     st.markdown("---")
     st.subheader("分析与结论")
@@ -94,6 +195,15 @@ if query_button and st.session_state.user_question:
         "没有 RAG 的模型完全依赖其内部训练数据，可能无法回答特定领域的问题，或者产生不准确的信息。"
     )
 
+# 缓存命中情况和启动耗时
+if ready.done() and ready.exception() is None:
+    rag_chain = ready.result()[0].active()[2]
+    if hasattr(rag_chain, "stats"):
+        with st.sidebar.expander("缓存命中统计"):
+            st.json(rag_chain.stats())
+with st.sidebar.expander("启动耗时"):
+    st.json(profiler.report())
+
 st.markdown("---")
 st.sidebar.info("请确保您的 `DASHSCOPE_API_KEY` 环境变量已设置。")
 st.sidebar.markdown("© 2025 RAG 演示程序")
\ No newline at end of file
@@ -0,0 +1,441 @@
+# rag_cache.py
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, List
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from pydantic import PrivateAttr
+
+DEFAULT_ANSWER_CACHE_PATH = "./answer_cache.sqlite3"
+
+
+def normalize_question(question):
+    """统一全角/半角、大小写、空白和结尾标点，让同一问题的不同写法得到相同的键。"""
+    text = unicodedata.normalize("NFKC", question).strip().lower()
+    text = re.sub(r"\s+", " ", text)
+    return text.rstrip("?？。.!！ ")
+
+
+def chunk_ids_of(docs):
+    """取文档的 chunk_id（data_prep 写入的内容哈希），老数据退化为内容哈希。"""
+    ids = []
+    for doc in docs:
+        chunk_id = doc.metadata.get("chunk_id") or getattr(doc, "id", None)
+        if not chunk_id:
+            chunk_id = hashlib.sha256(doc.page_content.encode("utf-8")).hexdigest()
+        ids.append(chunk_id)
+    return ids
+
+
+def prune_kb_versions(keep, path=DEFAULT_ANSWER_CACHE_PATH):
+    """
+    删除知识库版本（命名空间末尾的 ":kb=<版本>"，见 rag_core.get_rag_chain）不在 keep 中的
+    答案缓存和语义缓存条目，返回删除的行数。不带版本的命名空间不受影响。
+    """
+    if not os.path.exists(path):
+        return 0
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        deleted = 0
+        with conn:
+            for table in ("answers", "semantic_answers"):
+                if table not in tables:
+                    continue
+                namespaces = [row[0] for row in conn.execute(
+                    f"SELECT DISTINCT namespace FROM {table} WHERE namespace LIKE '%:kb=%'")]
+                for namespace in namespaces:
+                    if namespace.rsplit(":kb=", 1)[1] not in keep:
+                        deleted += conn.execute(f"DELETE FROM {table} WHERE namespace = ?", (namespace,)).rowcount
+        return deleted
+    finally:
+        conn.close()
+
+
+class LRUCache:
+    """线程安全的进程内 LRU 缓存，带命中/未命中计数。"""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+
+class LRUQueryEmbeddings(Embeddings):
+    """只缓存 embed_query 的结果；embed_documents 直接透传给底层模型。"""
+
+    def __init__(self, embeddings, maxsize=1024):
+        self.embeddings = embeddings
+        self.cache = LRUCache(maxsize)
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        vector = self.cache.get(text)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.cache.put(text, vector)
+        return vector
+
+
+class CachedRetriever(BaseRetriever):
+    """
+    带 LRU 的向量检索器：查询向量和检索结果都缓存在进程内，
+    重复问题不再计算嵌入，也不再执行 HNSW 搜索。
+    """
+    vectorstore: Any
+    k: int = 4
+    cache_size: int = 256
+
+    _embeddings: LRUQueryEmbeddings = PrivateAttr()
+    _results: LRUCache = PrivateAttr()
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self._embeddings = LRUQueryEmbeddings(self.vectorstore.embeddings, maxsize=self.cache_size * 4)
+        self._results = LRUCache(self.cache_size)
+
+    def embed_query(self, query):
+        """返回规范化问题的查询向量（走 LRU），语义缓存与检索共用同一个向量。"""
+        return self._embeddings.embed_query(normalize_question(query))
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        key = (normalize_question(query), self.k)
+        docs = self._results.get(key)
+        if docs is None:
+            vector = self.embed_query(query)
+            docs = self.vectorstore.similarity_search_by_vector(vector, k=self.k)
+            self._results.put(key, docs)
+        return docs
+
+    def clear(self):
+        self._embeddings.cache.clear()
+        self._results.clear()
+
+    def stats(self):
+        return {"query_embedding": self._embeddings.cache.stats(), "retrieval": self._results.stats()}
+
+
+class AnswerCache:
+    """
+    持久化的精确答案缓存，键为 (命名空间, 规范化问题, 检索到的 chunk_id 集合)。
+    知识库内容变化后 chunk_id 随之变化，旧答案自然不再命中。
+    """
+
+    def __init__(self, path=DEFAULT_ANSWER_CACHE_PATH, namespace=""):
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                key TEXT PRIMARY KEY,
+                question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                namespace TEXT NOT NULL DEFAULT ''
+            )
+        """)
+        # 早期版本的表没有 namespace 列（按命名空间清理时需要）
+        if "namespace" not in {row[1] for row in self._conn.execute("PRAGMA table_info(answers)")}:
+            self._conn.execute("ALTER TABLE answers ADD COLUMN namespace TEXT NOT NULL DEFAULT ''")
+        self._conn.commit()
+
+    def make_key(self, question, chunk_ids):
+        raw = "\0".join([self.namespace, normalize_question(question), *sorted(chunk_ids)])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT answer FROM answers WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, key, question, answer):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answers (key, question, answer, created_at, namespace) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, question, answer, time.time(), self.namespace),
+            )
+            self._conn.commit()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class SemanticAnswerCache:
+    """
+    语义答案缓存：保存 (问题向量, 答案, 来源 chunk_id)，新问题与某个历史问题的
+    余弦相似度不低于 threshold 时复用其答案。向量已归一化，相似度即点积。
+    条目持久化在 SQLite 中，启动时载入内存矩阵，查找是一次矩阵乘法。
+    """
+
+    def __init__(self, path=DEFAULT_ANSWER_CACHE_PATH, namespace="", threshold=0.92, max_entries=5000):
+        self.namespace = namespace
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS semantic_answers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                namespace TEXT NOT NULL,
+                question TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                answer TEXT NOT NULL,
+                chunk_ids TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._conn.commit()
+        rows = self._conn.execute(
+            "SELECT id, question, embedding, answer, chunk_ids FROM semantic_answers "
+            "WHERE namespace = ? ORDER BY id DESC LIMIT ?", (namespace, max_entries)
+        ).fetchall()[::-1]
+        self._ids = [row[0] for row in rows]
+        self._entries = [(row[1], row[3], json.loads(row[4])) for row in rows]
+        self._matrix = np.array([np.frombuffer(row[2], dtype=np.float32) for row in rows], dtype=np.float32)
+
+    def lookup(self, vector):
+        """返回最相似且超过阈值的 (question, answer, chunk_ids, similarity)，没有则返回 None。"""
+        with self._lock:
+            if not self._entries:
+                self.misses += 1
+                return None
+            scores = self._matrix @ np.asarray(vector, dtype=np.float32)
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+            question, answer, chunk_ids = self._entries[best]
+            return question, answer, chunk_ids, float(scores[best])
+
+    def add(self, vector, question, answer, chunk_ids):
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO semantic_answers (namespace, question, embedding, answer, chunk_ids, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (self.namespace, question, vector.tobytes(), answer, json.dumps(chunk_ids), time.time()),
+            )
+            self._ids.append(cursor.lastrowid)
+            self._entries.append((question, answer, chunk_ids))
+            self._matrix = vector[None, :] if self._matrix.size == 0 else np.vstack([self._matrix, vector])
+            if len(self._entries) > self.max_entries:
+                # 淘汰最早的条目
+                self._conn.execute("DELETE FROM semantic_answers WHERE id = ?", (self._ids[0],))
+                self._ids.pop(0)
+                self._entries.pop(0)
+                self._matrix = self._matrix[1:]
+            self._conn.commit()
+
+    def record_hit(self, fresh):
+        """lookup 命中后，由调用方确认来源是否仍然存在再记账。"""
+        if fresh:
+            self.hits += 1
+        else:
+            self.stale += 1
+            self.misses += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "stale": self.stale, "size": len(self._entries)}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedRetrievalQA:
+    """
+    与 RetrievalQA 接口一致的问答链（invoke({"query": ...}) 返回 result 和 source_documents），
+    检索结果命中答案缓存时不再调用 LLM。stream() 按事件流式产出来源文档和答案片段。
+    close() 关闭缓存的数据库连接，有查询正在进行时由最后一个结束的查询关闭。
+    """
+
+    def __init__(self, llm, retriever, prompt, answer_cache, semantic_cache=None, vectorstore=None,
+                 context_packer=None):
+        self.llm = llm
+        self.retriever = retriever
+        self.prompt = prompt
+        self.answer_cache = answer_cache
+        self.semantic_cache = semantic_cache
+        self.vectorstore = vectorstore
+        self.context_packer = context_packer
+        self.context_tokens = 0
+        self.context_tokens_saved = 0
+        self._inflight = 0
+        self._closing = False
+        self._inflight_lock = threading.Lock()
+
+    def invoke(self, inputs):
+        for event, payload in self.stream(inputs):
+            if event == "done":
+                return payload
+
+    def stream(self, inputs):
+        """
+        流式问答，依次产出 (事件, 数据)：
+        ("sources", 检索到的文档) 在检索完成、生成开始之前产出；
+        ("token", 文本片段) 随 LLM 输出逐段产出，命中缓存时整个答案作为一个片段；
+        ("done", 与 invoke 相同的结果字典)。
+        """
+        with self._inflight_lock:
+            self._inflight += 1
+        try:
+            yield from self._stream(inputs)
+        finally:
+            with self._inflight_lock:
+                self._inflight -= 1
+                close_now = self._closing and self._inflight == 0
+            if close_now:
+                self._close_caches()
+
+    def close(self):
+        with self._inflight_lock:
+            self._closing = True
+            if self._inflight:
+                return
+        self._close_caches()
+
+    def _close_caches(self):
+        self.answer_cache.close()
+        if self.semantic_cache is not None:
+            self.semantic_cache.close()
+
+    def _stream(self, inputs):
+        question = inputs["query"] if isinstance(inputs, dict) else inputs
+
+        # 词法快速通道（见 bm25_index.HybridRetriever）命中时不计算查询向量，也跳过语义缓存；
+        # BM25 结果只查一次，没走快速通道时直接交给 hybrid_search 复用
+        hits, docs = None, None
+        if hasattr(self.retriever, "lexical_search"):
+            hits = self.retriever.lexical_search(question)
+            docs = self.retriever.fast_path(question, hits)
+
+        vector = None
+        if docs is None and self.semantic_cache is not None:
+            vector = self.retriever.embed_query(question)
+            cached = self._semantic_lookup(vector)
+            if cached is not None:
+                answer, docs = cached
+                yield "sources", docs
+                yield "token", answer
+                yield "done", {"query": question, "result": answer, "source_documents": docs}
+                return
+
+        if docs is None:
+            docs = self.retriever.hybrid_search(question, hits) if hits is not None else self.retriever.invoke(question)
+        yield "sources", docs
+        chunk_ids = chunk_ids_of(docs)
+        key = self.answer_cache.make_key(question, chunk_ids)
+        answer = self.answer_cache.get(key)
+        result = {"query": question, "source_documents": docs}
+        if answer is None:
+            context = self._build_context(question, docs, result)
+            parts = []
+            for chunk in self.llm.stream(self.prompt.format(context=context, question=question)):
+                if chunk.content:
+                    parts.append(chunk.content)
+                    yield "token", chunk.content
+            answer = "".join(parts)
+            self.answer_cache.put(key, question, answer)
+        else:
+            yield "token", answer
+        if vector is not None:
+            self.semantic_cache.add(vector, question, answer, chunk_ids)
+        result["result"] = answer
+        yield "done", result
+
+    def _semantic_lookup(self, vector):
+        """语义缓存命中后，确认来源文本块仍在向量库中（chunk_id 即内容哈希），否则视为过期。"""
+        hit = self.semantic_cache.lookup(vector)
+        if hit is None:
+            return None
+        _, answer, chunk_ids, _ = hit
+        docs = self._fetch_sources(chunk_ids)
+        self.semantic_cache.record_hit(docs is not None)
+        return (answer, docs) if docs is not None else None
+
+    def _fetch_sources(self, chunk_ids):
+        if not chunk_ids:
+            return []
+        result = self.vectorstore.get(ids=chunk_ids, include=["documents", "metadatas"])
+        by_id = {
+            chunk_id: Document(page_content=text, metadata=metadata or {})
+            for chunk_id, text, metadata in zip(result["ids"], result["documents"], result["metadatas"])
+        }
+        if any(chunk_id not in by_id for chunk_id in chunk_ids):
+            return None
+        return [by_id[chunk_id] for chunk_id in chunk_ids]
+
+    def _build_context(self, question, docs, result):
+        """有 context_packer 时在 token 预算内打包上下文，并把节省的 token 数记入 result。"""
+        if self.context_packer is None:
+            # 与 "stuff" 链相同：把检索到的文本块用空行拼接后填入提示词
+            return "\n\n".join(doc.page_content for doc in docs)
+        context, original_tokens, packed_tokens = self.context_packer.pack(question, docs)
+        saved = max(original_tokens - packed_tokens, 0)
+        self.context_tokens += packed_tokens
+        self.context_tokens_saved += saved
+        result["context_tokens"] = packed_tokens
+        result["context_tokens_saved"] = saved
+        return context
+
+    def stats(self):
+        stats = {**self.retriever.stats(), "answer": self.answer_cache.stats()}
+        if self.semantic_cache is not None:
+            stats["semantic"] = self.semantic_cache.stats()
+        if self.context_packer is not None:
+            stats["context"] = {"tokens": self.context_tokens, "tokens_saved": self.context_tokens_saved}
+        return stats
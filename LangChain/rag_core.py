@@ -1,9 +1,9 @@
 # rag_core.py
 import os
-from langchain_openai import ChatOpenAI
-from langchain.chains import RetrievalQA
-from langchain.prompts import PromptTemplate
+import hashlib
 from dotenv import load_dotenv
+# langchain_openai / langchain / rag_cache 等较重的模块在 get_rag_chain、get_no_rag_chain 中才导入，
+# 只用 get_dashscope_api_key 时（例如 rag_app 启动检查）不会拖慢启动
 
 # Removed imports related to document loading, splitting, and Chroma creation
 # from langchain_community.document_loaders import TextLoader
@@ -25,34 +25,89 @@ def get_dashscope_api_key():
 
 # Removed get_vector_store function as its logic moved to data_preparation.py
 
-def get_rag_chain(vectorstore):
+LLM_MODEL_NAME = "qwen3-coder-30b-a3b-instruct"
+
+RAG_TEMPLATE = """
+    你是一个有用的问答助手。请根据提供的上下文信息来回答问题。
+    如果问题无法从上下文中找到答案，请说你不知道。
+
+    上下文:
+    {context}
+
+    问题: {question}
+    有帮助的答案:
+    """
+
+def get_rag_chain(vectorstore, use_cache=True, semantic_threshold=0.92, bm25_index=None, context_token_budget=1024,
+                  kb_version=None):
     """
     Creates a Retrieval-Augmented Generation (RAG) chain using the
     Aliyun Tongyi Qianwen model. It now directly receives the vectorstore.
+    With use_cache=True, query embeddings and retrieval results are kept in an
+    in-process LRU and answers in a persistent cache keyed on the question plus
+    the retrieved chunk ids; chain.stats() reports hit/miss counters.
+    semantic_threshold enables the semantic answer cache for paraphrased
+    questions (cosine similarity of bge embeddings); None disables it.
+    bm25_index (see data_prep.load_bm25_index) enables hybrid BM25 + vector
+    retrieval with reciprocal-rank fusion and a lexical fast path.
+    context_token_budget packs the retrieved chunks (merging overlaps, dropping
+    near-duplicate sentences) into at most that many prompt tokens; None sends
+    the chunks unchanged. Only the cached chain supports packing.
+    The context token budget and kb_version (the knowledge-base content hash,
+    see kb_manager.py) are part of the cache namespace, so answers generated from
+    differently packed contexts or an older knowledge base are never served;
+    the version is the ":kb=<version>" suffix (see rag_cache.prune_kb_versions).
     """
+    from langchain_openai import ChatOpenAI
+    from langchain.chains import RetrievalQA
+    from langchain.prompts import PromptTemplate
+    from rag_cache import AnswerCache, CachedRetriever, CachedRetrievalQA, SemanticAnswerCache
+    from bm25_index import HybridRetriever
+    from context_packer import ContextPacker
+
     dashscope_api_key = get_dashscope_api_key()
     llm = ChatOpenAI(
-        model_name="qwen3-coder-30b-a3b-instruct",
+        model_name=LLM_MODEL_NAME,
         openai_api_base="https://dashscope.aliyuncs.com/compatible-mode/v1",
         openai_api_key=dashscope_api_key,
         temperature=0
     )
 
-    template = """
-    你是一个有用的问答助手。请根据提供的上下文信息来回答问题。
-    如果问题无法从上下文中找到答案，请说你不知道。
-
-    上下文:
-    {context}
+    QA_CHAIN_PROMPT = PromptTemplate.from_template(RAG_TEMPLATE)
 
-    问题: {question}
-    有帮助的答案:
-    """
-    QA_CHAIN_PROMPT = PromptTemplate.from_template(template)
+    if use_cache:
+        # Namespace answers by model and prompt so changing either never serves stale answers
+        namespace = LLM_MODEL_NAME + ":" + hashlib.sha256(RAG_TEMPLATE.encode("utf-8")).hexdigest()[:16]
+        namespace += f":ctx{context_token_budget or 0}"
+        if kb_version:
+            namespace += ":kb=" + kb_version
+        semantic_cache = None
+        if semantic_threshold is not None:
+            semantic_cache = SemanticAnswerCache(namespace=namespace, threshold=semantic_threshold)
+        retriever = CachedRetriever(vectorstore=vectorstore)
+        if bm25_index is not None:
+            # The vector side fetches as many candidates as BM25 so RRF has both lists to fuse
+            retriever = HybridRetriever(
+                vector_retriever=CachedRetriever(vectorstore=vectorstore, k=10),
+                bm25=bm25_index,
+                fetch_k=10,
+            )
+        return CachedRetrievalQA(
+            llm,
+            retriever=retriever,
+            prompt=QA_CHAIN_PROMPT,
+            answer_cache=AnswerCache(namespace=namespace),
+            semantic_cache=semantic_cache,
+            vectorstore=vectorstore,
+            context_packer=ContextPacker(context_token_budget) if context_token_budget else None,
+        )
 
+    retriever = vectorstore.as_retriever()
+    if bm25_index is not None:
+        retriever = HybridRetriever(vector_retriever=vectorstore.as_retriever(search_kwargs={"k": 10}), bm25=bm25_index)
     qa_chain = RetrievalQA.from_chain_type(
         llm,
-        retriever=vectorstore.as_retriever(),
+        retriever=retriever,
         return_source_documents=True,
         chain_type_kwargs={"prompt": QA_CHAIN_PROMPT}
     )
@@ -62,9 +117,11 @@ def get_no_rag_chain():
     """
     Creates a pure LLM chain without retrieval, using the Aliyun Tongyi Qianwen model.
     """
+    from langchain_openai import ChatOpenAI
+
     dashscope_api_key = get_dashscope_api_key()
     llm = ChatOpenAI(
-        model_name="qwen3-coder-30b-a3b-instruct",
+        model_name=LLM_MODEL_NAME,
         openai_api_base="https://dashscope.aliyuncs.com/compatible-mode/v1",
         openai_api_key=dashscope_api_key,
         temperature=0
@@ -0,0 +1,120 @@
+# startup_profile.py
+import os
+import json
+import time
+import threading
+import importlib
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+PROFILE_LOG = "startup_profile.jsonl"
+
+
+class StartupProfiler:
+    """
+    记录启动过程各阶段的耗时（导入、模型加载、向量存储加载……），
+    save() 把每次启动的结果追加到 JSONL 日志，便于发现启动时间的回退。
+    """
+
+    def __init__(self):
+        self.phases = []  # [(阶段名, 秒)]
+        self.details = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.phases.append((name, seconds))
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def report(self):
+        with self._lock:
+            phases = {name: round(seconds, 3) for name, seconds in self.phases}
+        return {"phases": phases, "total": round(sum(phases.values()), 3), **self.details}
+
+    def save(self, path=PROFILE_LOG):
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"time": time.strftime("%Y-%m-%d %H:%M:%S"), **self.report()}, ensure_ascii=False) + "\n")
+
+
+def warm_up(profiler, file_path="knowledge_base.txt", backend="chroma"):
+    """
+    按阶段加载 RAG 应用需要的全部资源并计时，返回 (KnowledgeBaseManager, 纯 LLM 链)。
+    各阶段依次为：导入 LangChain 和所选向量存储的模块、导入嵌入推理库（torch / sentence-transformers
+    或 onnxruntime / transformers）、加载嵌入模型、加载向量存储并构建 RAG 链、创建纯 LLM 客户端。
+    """
+    with profiler.phase("import data_prep / kb_manager"):
+        import data_prep
+        from kb_manager import KnowledgeBaseManager
+        from rag_core import get_no_rag_chain
+
+    imports = {}
+    with profiler.phase(f"import langchain / {backend} store"):
+        imports.update(data_prep.preload_modules(backend))
+        # get_rag_chain / get_no_rag_chain 中延迟导入的模块
+        for name in ("rag_cache", "langchain_openai", "langchain.chains"):
+            start = time.perf_counter()
+            importlib.import_module(name)
+            imports[name] = time.perf_counter() - start
+
+    embedding_backend = os.getenv("EMBEDDING_BACKEND", "torch")
+    modules = data_prep.EMBEDDING_BACKEND_MODULES.get(embedding_backend, ())
+    with profiler.phase(f"import {' / '.join(modules[:2])}"):
+        imports.update(data_prep.preload_embedding_modules(embedding_backend))
+    profiler.details["imports"] = {name: round(seconds, 3) for name, seconds in imports.items()}
+
+    if not os.path.exists(file_path):
+        data_prep.generate_rag_data(file_path)
+
+    with profiler.phase("load embedding model"):
+        data_prep._get_embedding_function()
+
+    with profiler.phase("load vector store + rag chain"):
+        kb_manager = KnowledgeBaseManager(file_path, backend=backend)
+        kb_manager.active()
+
+    with profiler.phase("create no-rag llm"):
+        no_rag_chain = get_no_rag_chain()
+
+    profiler.save()
+    return kb_manager, no_rag_chain
+
+
+def start_warm_up(profiler, **kwargs):
+    """在后台线程中执行 warm_up，返回 Future；调用方在真正需要资源时再 result()。"""
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(warm_up(profiler, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name="rag-warm-up", daemon=True).start()
+    return future
+
+
+if __name__ == "__main__":
+    # 不启动 Streamlit，直接测一次冷启动各阶段耗时，并与日志中之前的记录对比
+    history = []
+    if os.path.exists(PROFILE_LOG):
+        with open(PROFILE_LOG, "r", encoding="utf-8") as f:
+            history = [json.loads(line) for line in f if line.strip()]
+    profiler = StartupProfiler()
+    warm_up(profiler, backend=os.getenv("VECTOR_BACKEND", "chroma"))
+    report = profiler.report()
+    print("--- 启动耗时 ---")
+    for name, seconds in report["phases"].items():
+        previous = [run["phases"][name] for run in history if name in run.get("phases", {})]
+        baseline = f"（之前的中位数 {sorted(previous)[len(previous) // 2]:.3f}s）" if previous else ""
+        print(f"{name:<40} {seconds:8.3f}s {baseline}")
+    print(f"{'total':<40} {report['total']:8.3f}s")
+    print("--- 导入耗时（按模块）---")
+    for name, seconds in sorted(report["imports"].items(), key=lambda item: -item[1]):
+        print(f"{name:<40} {seconds:8.3f}s")
@@ -1,7 +1,13 @@
+import os
+import sys
 import chromadb
 from pprint import pprint
 from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
 
+# 与 LangChain/data_prep.py 共用同一个嵌入缓存实现
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LangChain"))
+from embedding_cache import EmbeddingCache, cached_chroma_embedding_function
+
 
 chroma_client = chromadb.PersistentClient("./testdb")
 
@@ -10,6 +16,13 @@ chroma_client.delete_collection("my_collection")
 embedding_functions = SentenceTransformerEmbeddingFunction(
         model_name="BAAI/bge-small-zh"
 )
+# 已经嵌入过的文本直接从缓存读取，不再调用模型
+embedding_functions = cached_chroma_embedding_function(
+        embedding_functions,
+        EmbeddingCache(),
+        model_name="BAAI/bge-small-zh",
+        normalize=False
+)
 
 collection = chroma_client.create_collection(
     name="my_collection",
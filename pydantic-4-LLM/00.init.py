@@ -3,7 +3,7 @@ import sqlite3
 
 # 程序用途：
 # 1. 在customer_emails目录下生成三个邮件文本
-# 2. 初始化sqlite数据库，生成一张空的issue表
+# 2. 初始化sqlite数据库，生成一张空的issue表及其索引
 
 # 创建一个用于存放邮件文件的目录
 EMAIL_DIR = "./customer_emails"
@@ -62,6 +62,20 @@ def create_database_table():
             assigned_department TEXT NOT NULL
         )
     """)
+    # 按优先级、部门查询和分页用的索引
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_issues_priority ON issues(priority, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_issues_department ON issues(assigned_department, id)")
+    # 已处理邮件台账：邮件内容哈希 -> issues 行 id
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS processed_emails (
+            content_hash TEXT PRIMARY KEY,
+            issue_id INTEGER NOT NULL REFERENCES issues(id),
+            source TEXT,
+            processed_at REAL NOT NULL
+        )
+    """)
+    # WAL 模式：读操作不阻塞写入（该设置保存在数据库文件中）
+    cursor.execute("PRAGMA journal_mode=WAL")
     conn.commit()
     conn.close()
     print(f"数据库 '{DATABASE_NAME}' 和 'issues' 表已准备就绪。")
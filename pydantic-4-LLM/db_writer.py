@@ -0,0 +1,128 @@
+import time
+import sqlite3
+import threading
+
+# 程序用途：
+# 批量写入 issues 表的写入器
+# 1. 整个进程只保持一个长连接，数据库使用 WAL 模式，读操作不会阻塞写入
+# 2. CustomerIssue 先放入缓冲区，达到 batch_size 条或距上次写入超过 flush_interval 秒时，
+#    在一个事务里用 executemany 一次写入 issues，再用一次 executemany 写入台账
+# 3. 创建按 priority、assigned_department 查询所需的索引
+# 4. 维护已处理邮件台账 processed_emails（邮件内容哈希 -> issues 行 id），重复的邮件不再处理
+
+DATABASE_NAME = "customer_issues.db"
+
+INSERT_SQL = """
+    INSERT INTO issues (customer_name, product, issue_description, priority, assigned_department)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+
+def ensure_indexes(conn: sqlite3.Connection):
+    """
+    创建 issues 表的索引。索引末尾带上 id，按优先级/部门过滤并按 id 分页时可以直接走索引。
+    """
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_issues_priority ON issues(priority, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_issues_department ON issues(assigned_department, id)")
+    conn.commit()
+
+
+def ensure_ledger(conn: sqlite3.Connection):
+    """创建已处理邮件台账表。"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS processed_emails (
+            content_hash TEXT PRIMARY KEY,
+            issue_id INTEGER NOT NULL REFERENCES issues(id),
+            source TEXT,
+            processed_at REAL NOT NULL
+        )
+    """)
+    conn.commit()
+
+
+def load_processed_hashes(conn: sqlite3.Connection) -> set:
+    return {row[0] for row in conn.execute("SELECT content_hash FROM processed_emails")}
+
+
+class IssueWriter:
+    """
+    用法：
+        with IssueWriter() as writer:
+            writer.add(issue)
+    退出 with 块时会写入缓冲区中剩余的数据并关闭连接。
+    """
+
+    def __init__(self, database: str = DATABASE_NAME, batch_size: int = 500, flush_interval: float = 1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.inserted = 0
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._conn = sqlite3.connect(database, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # WAL 模式下 NORMAL 只在检查点时 fsync，单次提交不再等待磁盘
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        ensure_indexes(self._conn)
+        ensure_ledger(self._conn)
+
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+
+    def add(self, issue, content_hash: str = None, source: str = None):
+        """content_hash 不为空时，同一事务内把该邮件记入 processed_emails 台账。"""
+        with self._lock:
+            self._buffer.append((issue, content_hash, source))
+            if len(self._buffer) >= self.batch_size:
+                self._flush_locked()
+
+    def processed_hashes(self) -> set:
+        with self._lock:
+            return load_processed_hashes(self._conn)
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        now = time.time()
+        rows = [(issue.customer_name, issue.product, issue.issue_description,
+                 issue.priority, issue.assigned_department) for issue, _, _ in self._buffer]
+        # with conn: 在一个事务中写入，出错时整体回滚
+        with self._conn:
+            self._conn.executemany(INSERT_SQL, rows)
+            # 第一条 INSERT 之后本事务持有写锁，其他连接无法插入；id 是 AUTOINCREMENT，
+            # 所以这一批的行 id 是连续的，最后一个是 last_insert_rowid()
+            last_id = self._conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            first_id = last_id - len(rows) + 1
+            ledger_rows = [(content_hash, first_id + i, source, now)
+                           for i, (_, content_hash, source) in enumerate(self._buffer) if content_hash is not None]
+            if ledger_rows:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO processed_emails (content_hash, issue_id, source, processed_at) "
+                    "VALUES (?, ?, ?, ?)", ledger_rows
+                )
+        self.inserted += len(self._buffer)
+        self._buffer.clear()
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.flush_interval / 2):
+            with self._lock:
+                if self._buffer and time.monotonic() - self._last_flush >= self.flush_interval:
+                    self._flush_locked()
+
+    def close(self):
+        self._stop.set()
+        self._flusher.join()
+        self.flush()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
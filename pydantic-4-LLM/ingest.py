@@ -0,0 +1,155 @@
+import os
+import time
+import sqlite3
+import argparse
+from email import policy
+from email.parser import BytesParser
+from main import EMAIL_DIR, DATABASE_NAME, setup_llm
+from pipeline import RateLimiter, process_messages
+
+# 程序用途：
+# 增量邮件导入
+# 1. 支持 .txt 邮件、.eml 文件和 mbox 邮箱归档；mbox 逐行流式解析，不把整个归档读入内存
+# 2. 每封邮件按内容哈希查询 processed_emails 台账（见 db_writer.py），已处理过的不再提取、不再插入
+# 3. 在 ingested_files 表中记录每个文件的大小、修改时间和 mbox 的已读偏移量，
+#    文件没有变化时连读取都省掉；mbox 追加新邮件后只从上次的偏移量继续读
+# 4. --watch 监听模式：定期扫描，只处理新到达的邮件
+
+MESSAGE_EXTENSIONS = (".txt", ".eml", ".mbox")
+
+
+def ensure_file_state_table(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ingested_files (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            offset INTEGER NOT NULL
+        )
+    """)
+    conn.commit()
+
+
+def load_file_states(conn: sqlite3.Connection) -> dict:
+    return {row[0]: row[1:] for row in conn.execute("SELECT path, size, mtime, offset FROM ingested_files")}
+
+
+def save_file_states(conn: sqlite3.Connection, states: dict):
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO ingested_files (path, size, mtime, offset) VALUES (?, ?, ?, ?)",
+            [(path, *state) for path, state in states.items()],
+        )
+
+
+def message_to_text(msg) -> str:
+    """把解析后的邮件转换成与 customer_emails/*.txt 相同格式的纯文本。"""
+    body = msg.get_body(preferencelist=("plain",))
+    text = body.get_content() if body is not None else ""
+    return f"发件人：{msg.get('From', '')}\n主题：{msg.get('Subject', '')}\n\n{text}"
+
+
+def iter_mbox(path: str, start_offset: int = 0):
+    """
+    从 start_offset 开始逐行读取 mbox，每遇到一个 "From " 分隔行就产出上一封邮件。
+    产出 (来源, 邮件文本, 该邮件结束处的偏移量)，内存中只保留当前这一封邮件。
+    """
+    parser = BytesParser(policy=policy.default)
+    with open(path, "rb") as f:
+        f.seek(start_offset)
+        offset = message_start = start_offset
+        lines = []
+        previous_blank = True
+        for line in f:
+            if line.startswith(b"From ") and previous_blank:
+                if lines:
+                    yield f"{path}#{message_start}", message_to_text(parser.parsebytes(b"".join(lines))), offset
+                lines = []
+                message_start = offset
+            else:
+                # mbox 会把正文中以 "From " 开头的行转义成 ">From "
+                lines.append(line[1:] if line.startswith(b">From ") else line)
+            previous_blank = not line.strip()
+            offset += len(line)
+        if lines:
+            yield f"{path}#{message_start}", message_to_text(parser.parsebytes(b"".join(lines))), offset
+
+
+def iter_message_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.endswith(MESSAGE_EXTENSIONS):
+                        yield os.path.join(root, name)
+        elif path.endswith(MESSAGE_EXTENSIONS):
+            yield path
+
+
+def iter_new_messages(paths, file_states: dict, new_states: dict):
+    """
+    产出 (来源, 邮件文本)，跳过自上次运行以来没有变化的文件。
+    读完的文件状态写入 new_states，由调用方在邮件全部处理完成后保存。
+    """
+    parser = BytesParser(policy=policy.default)
+    for path in iter_message_files(paths):
+        stat = os.stat(path)
+        size, mtime, offset = file_states.get(path, (None, None, 0))
+        if size == stat.st_size and mtime == stat.st_mtime:
+            continue
+
+        if path.endswith(".mbox"):
+            # mbox 只会追加；变小说明被重写了，从头读起（已处理的邮件由台账跳过）
+            if stat.st_size < offset:
+                offset = 0
+            for source, text, offset in iter_mbox(path, offset):
+                yield source, text
+        elif path.endswith(".eml"):
+            with open(path, "rb") as f:
+                yield path, message_to_text(parser.parse(f))
+            offset = stat.st_size
+        else:
+            with open(path, "r", encoding="utf-8") as f:
+                yield path, f.read()
+            offset = stat.st_size
+        new_states[path] = (stat.st_size, stat.st_mtime, offset)
+
+
+def ingest_once(paths, conn, **pipeline_kwargs):
+    new_states = {}
+    stats = process_messages(iter_new_messages(paths, load_file_states(conn), new_states), **pipeline_kwargs)
+    # 有邮件提取失败的文件不更新状态，下次运行会重新读取（成功的邮件由台账跳过）
+    failed_files = {source.split("#", 1)[0] for source in stats["failed_sources"]}
+    save_file_states(conn, {path: state for path, state in new_states.items() if path not in failed_files})
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="增量导入客户邮件（.txt / .eml / mbox），跳过已处理的邮件")
+    parser.add_argument("paths", nargs="*", default=[EMAIL_DIR], help="邮件文件或目录")
+    parser.add_argument("--watch", action="store_true", help="持续监听，定期处理新到达的邮件")
+    parser.add_argument("--interval", type=float, default=10.0, help="监听模式下的扫描间隔（秒）")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rpm", type=int, default=60)
+    parser.add_argument("--tpm", type=int, default=100_000)
+    parser.add_argument("--batch-token-budget", type=int, default=None)
+    parser.add_argument("--structured", action="store_true")
+    parser.add_argument("--no-prioritize", action="store_true", help="不做优先级预判，按到达顺序处理")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(DATABASE_NAME)
+    ensure_file_state_table(conn)
+    pipeline_kwargs = dict(
+        workers=args.workers,
+        batch_token_budget=args.batch_token_budget,
+        structured=args.structured,
+        prioritize=not args.no_prioritize,
+        llm=setup_llm(),
+        limiter=RateLimiter(args.rpm, args.tpm),
+    )
+
+    ingest_once(args.paths, conn, **pipeline_kwargs)
+    while args.watch:
+        time.sleep(args.interval)
+        ingest_once(args.paths, conn, **pipeline_kwargs)
+    conn.close()
@@ -4,10 +4,11 @@ from langchain.prompts import PromptTemplate
 from langchain.schema.messages import HumanMessage, SystemMessage
 import os
 import json
-from typing import Optional, Literal
-from pydantic import BaseModel, Field
+from typing import Optional, Literal, Dict
+from pydantic import BaseModel, Field, ValidationError
 import json
 import sqlite3
+from db_writer import IssueWriter
 
 EMAIL_DIR = "./customer_emails"
 DATABASE_NAME = "customer_issues.db"
@@ -38,16 +39,12 @@ def setup_llm():
     )
     return llm
 
-def extract_issue_with_llm(llm, email_content: str) -> Optional[CustomerIssue]:
-    """
-    使用 DashScope LLM 结合 Pydantic 模型从邮件内容中提取客户问题。
-    """
-    schema = CustomerIssue.model_json_schema()
-    schema_str = json.dumps(schema, indent=2, ensure_ascii=False)
+# 步骤二：生成提示词模版
+# Schema 和模版在进程启动时只生成一次，每次调用只需填入邮件内容
+SCHEMA_STR = json.dumps(CustomerIssue.model_json_schema(), indent=2, ensure_ascii=False)
 
-    # 步骤二：生成提示词模版，并往模版里填入具体内容后生成提示词
-    # 完整且清晰的提示模板
-    template = """
+# 完整且清晰的提示模板
+EXTRACTION_TEMPLATE = """
 你是一个专业的客户服务数据分析师。你的任务是从客户的邮件内容中提取关键信息，
 并严格按照提供的 JSON Schema 格式输出。
 
@@ -62,12 +59,40 @@ JSON Schema 定义：
 
 JSON 输出:
 """
-    prompt = PromptTemplate.from_template(template)
+EXTRACTION_PROMPT = PromptTemplate.from_template(EXTRACTION_TEMPLATE).partial(schema=SCHEMA_STR)
+
+# 批量提取模版：多封邮件共用一份 Schema 和指令，输出按 email_id 标记的 JSON 数组
+BATCH_EXTRACTION_TEMPLATE = """
+你是一个专业的客户服务数据分析师。下面有多封客户邮件，每封邮件都用 <email id="..."> 和 </email> 包围。
+你的任务是分别从每封邮件中提取关键信息，并严格按照提供的 JSON Schema 格式输出。
+
+JSON Schema 定义（每个对象还必须额外包含字符串字段 "email_id"，值为对应邮件的 id）：
+```json
+{schema}
+客户邮件内容：
+
+{emails}
+请只输出一个 JSON 数组，数组中每个元素是从一封邮件中提取的 JSON 对象，每封邮件对应一个元素。
+不要包含任何额外的文字、解释或代码块分隔符（例如```json）。
+
+JSON 输出:
+"""
+BATCH_EXTRACTION_PROMPT = PromptTemplate.from_template(BATCH_EXTRACTION_TEMPLATE).partial(schema=SCHEMA_STR)
+
+SYSTEM_MESSAGE = SystemMessage(content="你是一个JSON数据提取专家。")
 
+
+def extract_issue_with_llm(llm, email_content: str, verbose: bool = True, raise_errors: bool = False) -> Optional[CustomerIssue]:
+    """
+    使用 DashScope LLM 结合 Pydantic 模型从邮件内容中提取客户问题。
+    verbose=False 时不打印提示词和原始响应（并发处理时避免输出交错）；
+    raise_errors=True 时把异常抛给调用方（例如由调用方决定是否重试），而不是返回 None。
+    """
     # 在提示词模版里填入实际内容，生成提示词，准备发送给 LLM
-    formatted_prompt = prompt.format(schema=schema_str, email_content=email_content)
+    formatted_prompt = EXTRACTION_PROMPT.format(email_content=email_content)
 
-    print(f"\n--- 发送给 LLM 的提示 (部分展示) ---\n{formatted_prompt[:500]}...\n----------------------------------")
+    if verbose:
+        print(f"\n--- 发送给 LLM 的提示 (部分展示) ---\n{formatted_prompt[:500]}...\n----------------------------------")
 
     # 步骤三：把指令和提示词发给LLM - 调用 LLM API
     try:
@@ -75,24 +100,69 @@ JSON 输出:
         # Chat models expect a list of messages, not a single string
         llm_raw_output = llm.invoke(
             [
-                SystemMessage(content="你是一个JSON数据提取专家。"),
+                SYSTEM_MESSAGE,
                 HumanMessage(content=formatted_prompt)
             ]
         ).content
 
         llm_raw_output = llm_raw_output.strip()
-        print(f"--- LLM 原始响应 ---\n{llm_raw_output}\n--------------------")
+        if verbose:
+            print(f"--- LLM 原始响应 ---\n{llm_raw_output}\n--------------------")
 
         # 步骤四：使用 Pydantic 解析和验证 LLM 输出
         data = json.loads(llm_raw_output)
         issue = CustomerIssue.model_validate(data)
-        print("--- Pydantic 验证成功！---")
+        if verbose:
+            print("--- Pydantic 验证成功！---")
         return issue
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"发生未知错误：{e}")
         return None
 
 
+def extract_issues_batch(llm, emails: Dict[str, str], raise_errors: bool = False) -> Dict[str, Optional[CustomerIssue]]:
+    """
+    把多封邮件（email_id -> 邮件内容）放进一次请求，Schema 和指令只发送一次。
+    返回 email_id -> CustomerIssue；缺失或验证失败的邮件对应 None，由调用方逐封重试。
+    raise_errors=True 时请求本身失败（网络、限流等）会抛出异常。
+    """
+    results: Dict[str, Optional[CustomerIssue]] = {email_id: None for email_id in emails}
+    emails_block = "\n\n".join(
+        f'<email id="{email_id}">\n{content.strip()}\n</email>' for email_id, content in emails.items()
+    )
+    formatted_prompt = BATCH_EXTRACTION_PROMPT.format(emails=emails_block)
+    try:
+        llm_raw_output = llm.invoke([SYSTEM_MESSAGE, HumanMessage(content=formatted_prompt)]).content
+    except Exception as e:
+        if raise_errors:
+            raise
+        print(f"批量提取请求失败：{e}")
+        return results
+
+    try:
+        items = json.loads(llm_raw_output.strip())
+    except json.JSONDecodeError as e:
+        print(f"批量提取结果不是合法 JSON：{e}")
+        return results
+    if not isinstance(items, list):
+        print("批量提取结果不是 JSON 数组。")
+        return results
+
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        email_id = str(item.pop("email_id", ""))
+        if email_id not in results or results[email_id] is not None:
+            continue
+        try:
+            results[email_id] = CustomerIssue.model_validate(item)
+        except ValidationError as e:
+            print(f"邮件 {email_id} 的提取结果验证失败：{e}")
+    return results
+
+
 def insert_issue_into_db(issue: CustomerIssue):
     """
     将 Pydantic CustomerIssue 对象插入到数据库中。
@@ -116,28 +186,32 @@ def insert_issue_into_db(issue: CustomerIssue):
 #-------------上面是函数定义部分--------------
 #  以下是主程序部分
 
-# 步骤一：连接大模型，生成大模型实例
-llm = setup_llm()
-
-#  从customer_emails目录读取所有邮件文件
-email_files = [os.path.join(EMAIL_DIR, f) for f in os.listdir(EMAIL_DIR) if f.endswith(".txt")]
-
-#  这个循环对每个邮件文件读取后进行处理
-for email_file_path in email_files:
-    print(f"\n===== 处理文件: {os.path.basename(email_file_path)} =====")
-    with open(email_file_path, "r", encoding="utf-8") as f:
-
-        # 读取每个邮件的内容
-        email_content = f.read()
-
-        # 使用 LLM 和 Pydantic 提取信息
-        customer_issue = extract_issue_with_llm(llm, email_content)
-
-        #步骤五：把数据存入数据库
-        if customer_issue:
-            print(f"提取到的信息: {customer_issue.model_dump_json(indent=2)}")
-            # 存储到数据库
-            insert_issue_into_db(customer_issue)
-        else:
-            print(f"未能从 {os.path.basename(email_file_path)} 提取有效信息。")
+if __name__ == "__main__":
+    # 步骤一：连接大模型，生成大模型实例
+    llm = setup_llm()
+
+    #  从customer_emails目录读取所有邮件文件
+    email_files = [os.path.join(EMAIL_DIR, f) for f in os.listdir(EMAIL_DIR) if f.endswith(".txt")]
+
+    #  整个程序共用一个数据库写入器，批量写入，退出时写入剩余数据
+    with IssueWriter(DATABASE_NAME) as writer:
+        #  这个循环对每个邮件文件读取后进行处理
+        for email_file_path in email_files:
+            print(f"\n===== 处理文件: {os.path.basename(email_file_path)} =====")
+            with open(email_file_path, "r", encoding="utf-8") as f:
+
+                # 读取每个邮件的内容
+                email_content = f.read()
+
+                # 使用 LLM 和 Pydantic 提取信息
+                customer_issue = extract_issue_with_llm(llm, email_content)
+
+                #步骤五：把数据存入数据库
+                if customer_issue:
+                    print(f"提取到的信息: {customer_issue.model_dump_json(indent=2)}")
+                    # 存储到数据库（先进入缓冲区，批量提交）
+                    writer.add(customer_issue)
+                else:
+                    print(f"未能从 {os.path.basename(email_file_path)} 提取有效信息。")
+    print(f"成功将 {writer.inserted} 条客户问题插入到数据库。")
 
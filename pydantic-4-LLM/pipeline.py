@@ -0,0 +1,280 @@
+import os
+import time
+import queue
+import random
+import hashlib
+import argparse
+import threading
+import openai
+from main import EMAIL_DIR, DATABASE_NAME, setup_llm, extract_issue_with_llm, extract_issues_batch
+from db_writer import IssueWriter
+from structured_extract import extract_issue_structured
+from scheduler import PriorityScheduler, triage
+
+# 程序用途：
+# 并发版的邮件提取流水线（main.py 的逐个处理版本的加速版）
+# 1. 多个工作线程并发调用 LLM 提取信息，线程数可配置
+# 2. 速率限制器同时限制每分钟请求数和每分钟 token 数
+# 3. 遇到限流、超时、连接错误等临时故障时指数退避重试
+# 4. 单独的写入线程把验证通过的 CustomerIssue 交给 IssueWriter 批量写入数据库
+# 5. 可选的批量提取模式：多封邮件按 token 预算打包进一次请求，共用一份 Schema 和指令
+# 6. 可选的结构化输出模式：JSON 模式 + 流式逐字段验证（见 structured_extract.py）
+# 7. 按邮件内容哈希查询 processed_emails 台账，已经处理过的邮件直接跳过
+# 8. 工作线程从按优先级调度的队列中取任务（见 scheduler.py），紧急邮件不必排在普通邮件后面
+
+# 可以重试的临时故障；JSON 解析或 Pydantic 验证失败不属于此类
+TRANSIENT_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+# 每次请求中除邮件正文以外的提示词（Schema + 指令）和输出的大致 token 数
+PROMPT_OVERHEAD_TOKENS = 600
+OUTPUT_TOKENS = 200
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中文约一字一个 token，其他字符约四个一个 token。"""
+    cjk = sum(1 for ch in text if "一" <= ch <= "鿿")
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+class RateLimiter:
+    """
+    令牌桶限流器，同时限制每分钟请求数 (RPM) 和每分钟 token 数 (TPM)。
+    acquire 会阻塞直到两个桶都有足够的额度。
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._request_budget = float(requests_per_minute)
+        self._token_budget = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._request_budget = min(self.requests_per_minute,
+                                   self._request_budget + elapsed * self.requests_per_minute / 60)
+        self._token_budget = min(self.tokens_per_minute,
+                                 self._token_budget + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens: int):
+        # 单个请求超过整个 TPM 时按 TPM 计，避免永远等不到额度
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._request_budget >= 1 and self._token_budget >= tokens:
+                    self._request_budget -= 1
+                    self._token_budget -= tokens
+                    return
+                wait = max((1 - self._request_budget) * 60 / self.requests_per_minute,
+                           (tokens - self._token_budget) * 60 / self.tokens_per_minute)
+            time.sleep(max(wait, 0.01))
+
+
+def call_with_retry(fn, limiter: RateLimiter, tokens: int, max_retries: int = 4):
+    """限流后调用 fn，临时故障按指数退避（带随机抖动）重试；其他异常或重试耗尽时返回 None。"""
+    for attempt in range(max_retries + 1):
+        limiter.acquire(tokens)
+        try:
+            return fn()
+        except TRANSIENT_ERRORS as e:
+            if attempt == max_retries:
+                print(f"重试 {max_retries} 次后仍然失败：{e}")
+                return None
+            delay = min(2 ** attempt, 30) + random.uniform(0, 1)
+            print(f"临时故障（{type(e).__name__}），{delay:.1f} 秒后第 {attempt + 1} 次重试...")
+            time.sleep(delay)
+        except Exception as e:
+            print(f"提取失败：{e}")
+            return None
+
+
+def extract_with_retry(llm, email_content: str, limiter: RateLimiter, max_retries: int = 4, structured: bool = False):
+    tokens = PROMPT_OVERHEAD_TOKENS + estimate_tokens(email_content) + OUTPUT_TOKENS
+    if structured:
+        fn = lambda: extract_issue_structured(llm, email_content, raise_errors=True)
+    else:
+        fn = lambda: extract_issue_with_llm(llm, email_content, verbose=False, raise_errors=True)
+    return call_with_retry(fn, limiter, tokens, max_retries)
+
+
+def extract_batch_with_retry(llm, emails: dict, limiter: RateLimiter, max_retries: int = 4, structured: bool = False):
+    """
+    批量提取 {email_id: 邮件内容}；整批请求失败或部分邮件没有得到有效结果时，
+    把这些邮件逐封重新提取。
+    """
+    tokens = PROMPT_OVERHEAD_TOKENS + sum(estimate_tokens(c) + OUTPUT_TOKENS for c in emails.values())
+    results = call_with_retry(
+        lambda: extract_issues_batch(llm, emails, raise_errors=True),
+        limiter, tokens, max_retries,
+    ) or {email_id: None for email_id in emails}
+    for email_id, issue in results.items():
+        if issue is None:
+            results[email_id] = extract_with_retry(llm, emails[email_id], limiter, max_retries, structured)
+    return results
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.strip().encode("utf-8")).hexdigest()
+
+
+def writer_loop(issues: queue.Queue, writer: IssueWriter):
+    """
+    写入阶段：把队列中的 (CustomerIssue, 内容哈希, 来源) 交给 IssueWriter，
+    由它按数量或时间批量写入并记录台账。收到 None 表示上游结束。
+    """
+    while True:
+        item = issues.get()
+        if item is None:
+            break
+        writer.add(*item)
+
+
+def iter_email_files(email_files):
+    for email_file_path in email_files:
+        with open(email_file_path, "r", encoding="utf-8") as f:
+            yield email_file_path, f.read()
+
+
+def run_pipeline(email_files, **kwargs):
+    """处理一组 .txt 邮件文件，参数见 process_messages。"""
+    return process_messages(iter_email_files(email_files), **kwargs)
+
+
+def process_messages(messages, workers=4, requests_per_minute=60, tokens_per_minute=100_000,
+                     max_retries=4, write_batch_size=50, batch_token_budget=None, structured=False,
+                     prioritize=True, slo_seconds=None, queue_size=1000, max_batch_size=20,
+                     llm=None, limiter=None):
+    """
+    并发处理 (来源, 邮件内容) 序列。messages 可以是生成器：调度队列最多容纳 queue_size 封邮件，
+    不会一次把所有邮件读入内存。已在 processed_emails 台账中的邮件直接跳过。
+    prioritize=True 时先用 triage 预估优先级，按各优先级的 SLO 调度；否则按到达顺序处理。
+    batch_token_budget 为 None 时每封邮件单独请求；否则工作线程从队列中连续取出多封邮件，
+    在该 token 预算内打包进一次请求（Schema 和指令每次请求只算一次）。
+    structured=True 时逐封提取使用 JSON 模式和流式逐字段验证。
+    llm、limiter 可以由调用方传入，以便多次调用（例如监听模式）共用同一个实例和速率额度。
+    """
+    llm = llm or setup_llm()
+    limiter = limiter or RateLimiter(requests_per_minute, tokens_per_minute)
+    # 有界队列：写入跟不上时让提取线程等待，避免内存无限增长
+    issues = queue.Queue(maxsize=workers * 4)
+    stats = {"total": 0, "skipped": 0, "inserted": 0, "failed": 0, "failed_sources": []}
+    stats_lock = threading.Lock()
+    issue_writer = IssueWriter(DATABASE_NAME, batch_size=write_batch_size)
+    writer = threading.Thread(target=writer_loop, args=(issues, issue_writer), daemon=True)
+    writer.start()
+    scheduler = PriorityScheduler(slo_seconds, maxsize=queue_size)
+
+    processed = issue_writer.processed_hashes()
+
+    def message_cost(message):
+        return estimate_tokens(message[1]) + OUTPUT_TOKENS
+
+    def process(batch):
+        # 每个工作单元是一组邮件；逐封模式下每组只有一封
+        emails = dict(batch)
+        if len(emails) == 1:
+            (source, email_content), = emails.items()
+            results = {source: extract_with_retry(llm, email_content, limiter, max_retries, structured)}
+        else:
+            results = extract_batch_with_retry(llm, emails, limiter, max_retries, structured)
+        for source, issue in results.items():
+            if issue:
+                issues.put((issue, content_hash(emails[source]), source))
+        return results
+
+    def report(results):
+        for source, issue in results.items():
+            name = os.path.basename(source)
+            if issue:
+                print(f"✅ {name}: {issue.customer_name} / {issue.priority}")
+            else:
+                with stats_lock:
+                    stats["failed"] += 1
+                    stats["failed_sources"].append(source)
+                print(f"❌ 未能从 {name} 提取有效信息。")
+
+    def worker():
+        carry = None
+        while True:
+            first = carry or scheduler.get()
+            carry = None
+            if first is None:
+                break
+            batch, used = [first], PROMPT_OVERHEAD_TOKENS + message_cost(first)
+            if batch_token_budget:
+                # 按调度顺序继续取邮件打包，直到超出 token 预算；放不下的那封留给下一次请求
+                while len(batch) < max_batch_size:
+                    message = scheduler.get(block=False)
+                    if message is None:
+                        break
+                    if used + message_cost(message) > batch_token_budget:
+                        carry = message
+                        break
+                    batch.append(message)
+                    used += message_cost(message)
+            report(process(batch))
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for source, content in messages:
+        stats["total"] += 1
+        digest = content_hash(content)
+        if digest in processed:
+            stats["skipped"] += 1
+            continue
+        # 同一次运行中重复出现的邮件也只处理一次
+        processed.add(digest)
+        scheduler.put((source, content), triage(content) if prioritize else "中")
+    scheduler.close()
+    for thread in threads:
+        thread.join()
+    issues.put(None)
+    writer.join()
+    issue_writer.close()
+    stats["inserted"] = issue_writer.inserted
+    stats["scheduling"] = scheduler.stats()
+    elapsed = time.perf_counter() - start
+
+    handled = stats["total"] - stats["skipped"]
+    if handled == 0:
+        return stats
+    print(f"\n共 {stats['total']} 封邮件，跳过已处理 {stats['skipped']} 封，写入 {stats['inserted']} 条，"
+          f"失败 {stats['failed']} 条，耗时 {elapsed:.1f} 秒（{handled / elapsed if elapsed else 0:.2f} 封/秒）。")
+    for priority, s in stats["scheduling"].items():
+        if s["count"]:
+            print(f"   {priority}: {s['count']} 封，平均等待 {s['avg_wait']:.1f} 秒，"
+                  f"最长等待 {s['max_wait']:.1f} 秒，超出 SLO {s['slo_missed']} 封")
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="并发提取客户邮件中的问题并写入数据库")
+    parser.add_argument("--email-dir", default=EMAIL_DIR)
+    parser.add_argument("--workers", type=int, default=4, help="并发调用 LLM 的线程数")
+    parser.add_argument("--rpm", type=int, default=60, help="每分钟最多请求数")
+    parser.add_argument("--tpm", type=int, default=100_000, help="每分钟最多 token 数")
+    parser.add_argument("--max-retries", type=int, default=4)
+    parser.add_argument("--write-batch-size", type=int, default=50)
+    parser.add_argument("--batch-token-budget", type=int, default=None,
+                        help="启用批量提取模式：每次请求打包的邮件 token 上限")
+    parser.add_argument("--structured", action="store_true",
+                        help="使用 JSON 模式并在流式输出中逐字段验证，字段无效时提前中断")
+    parser.add_argument("--no-prioritize", action="store_true", help="不做优先级预判，按到达顺序处理")
+    args = parser.parse_args()
+
+    email_files = [os.path.join(args.email_dir, f) for f in os.listdir(args.email_dir) if f.endswith(".txt")]
+    run_pipeline(email_files, workers=args.workers, requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                 max_retries=args.max_retries, write_batch_size=args.write_batch_size,
+                 batch_token_budget=args.batch_token_budget, structured=args.structured,
+                 prioritize=not args.no_prioritize)
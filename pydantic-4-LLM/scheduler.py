@@ -0,0 +1,100 @@
+import re
+import time
+import heapq
+import itertools
+import threading
+
+# 程序用途：
+# 按优先级调度邮件提取任务
+# 1. triage：在调用 LLM 之前，用主题行上的关键词粗略判断优先级（低/中/高/紧急），开销几乎为零
+# 2. PriorityScheduler：放在 LLM 工作线程前面的优先队列。每个优先级有各自的延迟目标 (SLO)，
+#    任务的截止时间 = 到达时间 + SLO，总是先处理截止时间最早的任务（EDF）。
+#    紧急邮件的 SLO 短，会排到普通邮件前面；普通邮件等得足够久后截止时间也会变成最早，不会被饿死。
+# 3. 统计每个优先级的等待时间和超出 SLO 的次数
+
+PRIORITIES = ("紧急", "高", "中", "低")
+
+# 各优先级的延迟目标（秒）：从进入队列到开始处理
+DEFAULT_SLO_SECONDS = {"紧急": 30, "高": 120, "中": 600, "低": 1800}
+
+# 关键词按优先级从高到低匹配，命中即返回
+TRIAGE_KEYWORDS = {
+    "紧急": ("紧急", "立即", "马上", "急需", "无法开机", "完全无法", "宕机", "urgent", "asap"),
+    "高": ("尽快", "无法", "故障", "不能", "失败", "投诉", "优先级比较高"),
+    "低": ("咨询", "请问", "建议", "了解一下", "不着急"),
+}
+
+_SUBJECT_RE = re.compile(r"^\s*(?:主题|Subject)\s*[:：]\s*(.*)$", re.MULTILINE | re.IGNORECASE)
+
+
+def triage(email_content: str) -> str:
+    """根据主题行（没有主题时用正文开头）的关键词预估优先级，默认为“中”。"""
+    match = _SUBJECT_RE.search(email_content)
+    text = (match.group(1) if match else email_content[:200]).lower()
+    for priority, keywords in TRIAGE_KEYWORDS.items():
+        if any(keyword in text for keyword in keywords):
+            return priority
+    return "中"
+
+
+class PriorityScheduler:
+    """
+    线程安全的最早截止时间优先 (EDF) 队列。
+    put 在队列满时阻塞；get 在队列空时阻塞，close 之后队列取空则返回 None。
+    """
+
+    def __init__(self, slo_seconds: dict = None, maxsize: int = 10_000):
+        self.slo_seconds = slo_seconds or DEFAULT_SLO_SECONDS
+        self.maxsize = maxsize
+        self._heap = []
+        self._seq = itertools.count()
+        self._closed = False
+        self._cond = threading.Condition()
+        self._stats = {p: {"count": 0, "total_wait": 0.0, "max_wait": 0.0, "slo_missed": 0} for p in PRIORITIES}
+
+    def put(self, item, priority: str = "中"):
+        now = time.monotonic()
+        deadline = now + self.slo_seconds.get(priority, self.slo_seconds["中"])
+        with self._cond:
+            while len(self._heap) >= self.maxsize:
+                self._cond.wait()
+            heapq.heappush(self._heap, (deadline, next(self._seq), now, priority, item))
+            self._cond.notify_all()
+
+    def get(self, block: bool = True):
+        with self._cond:
+            while not self._heap:
+                if self._closed or not block:
+                    return None
+                self._cond.wait()
+            deadline, _, enqueued, priority, item = heapq.heappop(self._heap)
+            self._record(priority, enqueued, deadline)
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _record(self, priority, enqueued, deadline):
+        now = time.monotonic()
+        wait = now - enqueued
+        stats = self._stats.setdefault(priority, {"count": 0, "total_wait": 0.0, "max_wait": 0.0, "slo_missed": 0})
+        stats["count"] += 1
+        stats["total_wait"] += wait
+        stats["max_wait"] = max(stats["max_wait"], wait)
+        if now > deadline:
+            stats["slo_missed"] += 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                priority: {
+                    "count": s["count"],
+                    "avg_wait": s["total_wait"] / s["count"] if s["count"] else 0.0,
+                    "max_wait": s["max_wait"],
+                    "slo_missed": s["slo_missed"],
+                }
+                for priority, s in self._stats.items()
+            }
@@ -0,0 +1,144 @@
+import json
+from typing import Optional
+import openai
+from pydantic import TypeAdapter, ValidationError
+from langchain.schema.messages import HumanMessage
+from main import CustomerIssue, EXTRACTION_PROMPT, SYSTEM_MESSAGE
+
+# 程序用途：
+# 结构化输出 + 流式增量验证的提取方式
+# 1. 请求时使用 OpenAI 兼容接口的 JSON 模式 (response_format={"type": "json_object"})，
+#    模型只会输出 JSON，不会夹带代码块分隔符或解释文字；服务端不支持时自动退回普通模式
+# 2. 流式接收响应，每解析完一个字段就立即用 CustomerIssue 中该字段的类型验证
+# 3. 某个字段验证失败（例如 priority 不在 低/中/高/紧急 中）时立即中断请求，不再等待剩余输出
+
+
+class FieldValidationAbort(ValueError):
+    """流式解析过程中某个字段验证失败，提前中断请求。"""
+
+    def __init__(self, field, value, error):
+        super().__init__(f"字段 {field} 的值 {value!r} 无效：{error}")
+        self.field = field
+        self.value = value
+
+
+class IncrementalIssueParser:
+    """
+    增量解析扁平的 JSON 对象（CustomerIssue 的字段都是字符串）。
+    每次 feed 一段文本，字段值一旦完整就立即验证；finish 时做整体的 model_validate。
+    对象开始前的多余文字（例如 ```json）会被跳过。
+    """
+
+    def __init__(self, model=CustomerIssue):
+        self.model = model
+        self.fields = {}
+        self.done = False
+        self._adapters = {name: TypeAdapter(info.annotation) for name, info in model.model_fields.items()}
+        self._buf = ""
+        self._pos = 0
+        self._state = "start"
+        self._key = None
+        self._token_start = 0
+        self._escape = False
+
+    def feed(self, text: str):
+        self._buf += text
+        while self._pos < len(self._buf) and not self.done:
+            ch = self._buf[self._pos]
+            state = self._state
+            if state == "start":
+                if ch == "{":
+                    self._state = "key"
+            elif state in ("in_key", "in_value"):
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    value = json.loads('"' + self._buf[self._token_start:self._pos] + '"')
+                    if state == "in_key":
+                        self._key = value
+                        self._state = "colon"
+                    else:
+                        self._on_field(self._key, value)
+                        self._state = "comma"
+            elif ch.isspace():
+                pass
+            elif state == "key":
+                if ch == '"':
+                    self._state = "in_key"
+                    self._token_start = self._pos + 1
+                elif ch == "}":
+                    self.done = True
+            elif state == "colon" and ch == ":":
+                self._state = "value"
+            elif state == "value":
+                if ch != '"':
+                    # CustomerIssue 的字段都是字符串，出现其他类型的值可以直接判定失败
+                    raise FieldValidationAbort(self._key, ch, "值必须是字符串")
+                self._state = "in_value"
+                self._token_start = self._pos + 1
+            elif state == "comma":
+                if ch == ",":
+                    self._state = "key"
+                elif ch == "}":
+                    self.done = True
+            self._pos += 1
+
+    def _on_field(self, key, value):
+        adapter = self._adapters.get(key)
+        if adapter is not None:
+            try:
+                adapter.validate_python(value)
+            except ValidationError as e:
+                raise FieldValidationAbort(key, value, e.errors()[0]["msg"])
+        self.fields[key] = value
+
+    def finish(self):
+        return self.model.model_validate(self.fields)
+
+
+# 服务端不支持 JSON 模式时记住结果，之后不再尝试
+_json_mode_supported = True
+
+
+def _stream(llm, messages):
+    global _json_mode_supported
+    if _json_mode_supported:
+        try:
+            stream = llm.bind(response_format={"type": "json_object"}).stream(messages)
+            first = next(stream, None)
+        except openai.BadRequestError as e:
+            if "response_format" not in str(e):
+                raise
+            _json_mode_supported = False
+        else:
+            if first is not None:
+                yield first
+            yield from stream
+            return
+    yield from llm.stream(messages)
+
+
+def extract_issue_structured(llm, email_content: str, raise_errors: bool = False) -> Optional[CustomerIssue]:
+    """
+    与 extract_issue_with_llm 相同的提示词，但使用 JSON 模式并在流式输出过程中逐字段验证。
+    raise_errors=True 时异常（包括 FieldValidationAbort）抛给调用方。
+    """
+    messages = [SYSTEM_MESSAGE, HumanMessage(content=EXTRACTION_PROMPT.format(email_content=email_content))]
+    parser = IncrementalIssueParser()
+    stream = _stream(llm, messages)
+    try:
+        for chunk in stream:
+            parser.feed(chunk.content)
+            if parser.done:
+                break
+        return parser.finish()
+    except Exception as e:
+        if raise_errors:
+            raise
+        print(f"结构化提取失败：{e}")
+        return None
+    finally:
+        # 提前结束时关闭流，释放上游连接，不再接收剩余 token
+        stream.close()